@@ -1,11 +1,30 @@
 from collections import OrderedDict
-from flask import Flask, request, abort, Blueprint, redirect
+from logging import INFO
+from random import random
+from time import perf_counter
+from flask import Flask, request, abort, Blueprint, redirect, Response, stream_with_context, g, json, \
+    after_this_request, send_file, url_for
 from flask_restx.apidoc import apidoc
+from werkzeug.datastructures import FileStorage
 from werkzeug.exceptions import HTTPException
-from converter import generate_tei_header, generate_tei_page, generate_tei_document
+from binary import encode_element, BINARY_MIMETYPE
+from compression import decompress_request, decompress_upload, compress_response, is_compressible, ENCODINGS
+from converter import generate_tei_header, convert_tei_page, generate_tei_document, stream_tei_document, \
+    generate_tei_pages, generate_tei_document_from_json, append_tei_document
 from info import APP_VERSION
-from models import generate_merge_parser, generate_header_model, generate_page_model
-from utils import xml_response, xml_response_handler, exception_handler, prepare_filter, content_type_json, validate
+from jobs import merge_jobs
+from json_stream import read_page
+from models import generate_merge_parser, generate_append_parser, generate_job_parser, generate_header_model, \
+    generate_page_model, generate_pages_model, generate_document_model, COMPACT_HELP, PAGES_FORMAT_HELP, \
+    PAGE_FORMAT_HELP
+from page_cache import page_cache
+from metrics import stage, server_timing, record_request, render_metrics
+from settings import PRELOAD_SCHEMA, MERGE_WORKERS, MAX_CONTENT_LENGTH, LOG_SAMPLE_RATE, LOG_BODY_MAX_SIZE, \
+    METRICS_ENABLED, SERVER_TIMING, VALIDATION_SAMPLE_RATE, VALIDATE_AFTER_RESPONSE, COMPRESS_RESPONSES
+from utils import xml_response, xml_response_handler, exception_handler, prepare_filter, content_type_json, validate, \
+    schema_cache, prepare_flag, spool, is_ndjson, read_ndjson, stream_pages_xml, stream_pages_ndjson, \
+    request_log_record, set_request_log, count_pages, read_json, count_bytes, close_after, \
+    json_response
 from flask_restx import Api, Resource
 
 URL_PREFIX = '/tei'
@@ -18,10 +37,15 @@ api.representations = OrderedDict([("application/xml", xml_response_handler)])
 
 # register app with api
 app = Flask(__name__)
+app.config['MAX_CONTENT_LENGTH'] = MAX_CONTENT_LENGTH
 app.register_error_handler(HTTPException, exception_handler)
 app.register_blueprint(blueprint, url_prefix=URL_PREFIX)
 app.url_map.strict_slashes = False
 
+# structured request log, one JSON line per request
+request_logger = app.logger.getChild('requests')
+request_logger.setLevel(INFO)
+
 # modify response content type for swagger.json specification
 app.view_functions['api.specs'] = content_type_json(app.view_functions.get('api.specs'))
 
@@ -29,12 +53,90 @@ app.view_functions['api.specs'] = content_type_json(app.view_functions.get('api.
 merge_space = api.namespace('merge')
 convert_space = api.namespace('convert')
 merge_parser = generate_merge_parser(api)
+append_parser = generate_append_parser(api)
+job_parser = generate_job_parser(api)
+
+# compile the validation schema before the first merge request
+if PRELOAD_SCHEMA:
+    schema_cache.load(app.logger)
 
 
 @app.before_request
-def log_request_info():
-    app.logger.debug('Headers: \n%s', str(request.headers).strip())
-    app.logger.debug('Body: \n%s\n', request.get_data())
+def start_request_log():
+    g.request_start = perf_counter()
+    g.request_log = {}
+
+
+@app.before_request
+def decompress_body():
+    decompress_request(request.environ)
+
+
+@app.after_request
+def log_request(response):
+    """Write one JSON line per request, the duration includes streaming of the response"""
+    if response.status_code < 400 and random() >= LOG_SAMPLE_RATE:
+        return response
+    start = g.get('request_start', perf_counter())
+    record = request_log_record(response, LOG_BODY_MAX_SIZE)
+    record['view_ms'] = round((perf_counter() - start) * 1000, 3)
+    # fields set by the view, streamed views keep updating them after this hook
+    fields = g.get('request_log', {})
+
+    def write():
+        record.update(fields)
+        record['duration_ms'] = round((perf_counter() - start) * 1000, 3)
+        request_logger.info(json.dumps(record))
+    response.call_on_close(write)
+    return response
+
+
+@app.after_request
+def add_metrics(response):
+    if SERVER_TIMING and server_timing():
+        response.headers['Server-Timing'] = ', '.join(
+            '%s;dur=%.3f' % (name, seconds * 1000) for name, seconds in server_timing().items())
+    if METRICS_ENABLED:
+        start = g.get('request_start', perf_counter())
+        endpoint = request.endpoint or 'unknown'
+        code = response.status_code
+        if response.is_streamed:
+            size = [0]
+            response.response = count_bytes(response.response, size)
+            response.call_on_close(lambda: record_request(endpoint, code, perf_counter() - start, size[0]))
+        else:
+            record_request(endpoint, code, perf_counter() - start, response.content_length)
+    return response
+
+
+@app.after_request
+def compress(response):
+    """Compress the response before its size is measured by the metrics and the request log"""
+    if COMPRESS_RESPONSES and request.method != 'HEAD' and is_compressible(response):
+        encoding = request.accept_encodings.best_match(ENCODINGS)
+        if encoding:
+            return compress_response(response, encoding)
+    return response
+
+
+if METRICS_ENABLED:
+    @app.route(URL_PREFIX + '/metrics')
+    def metrics():
+        return Response(render_metrics(), mimetype='text/plain; version=0.0.4')
+
+
+def validate_document(document):
+    """Validate a sample of the documents, before the response or after it is sent, errors are only logged"""
+    if random() >= VALIDATION_SAMPLE_RATE:
+        return
+    if not VALIDATE_AFTER_RESPONSE:
+        validate(document, app.logger)
+        return
+
+    @after_this_request
+    def validate_on_close(response):
+        response.call_on_close(lambda: validate(document, app.logger))
+        return response
 
 
 @app.route('/')
@@ -44,41 +146,198 @@ def default_page():
 
 @merge_space.route('')
 @merge_space.expect(merge_parser)
+@merge_space.param('compact', COMPACT_HELP, _in='query', type='boolean')
 class Merge(Resource):
     @merge_space.response(200, 'Spojenie úspešne prebehlo. TEI dokument vrátený v response.')
     @merge_space.doc(description='Spojenie hlavičky so stránkami + prípadne filtrovanie obsahu.')
     def post(self):
-        if 'header' not in request.files:
+        with stage('read'):
+            files = request.files
+        if 'header' not in files:
             abort(400, description="A file with name `header` does not found in the form data.")
-        pages = request.files.getlist("page[]")
+        header = decompress_upload(files.get('header'))
+        pages = [decompress_upload(page) for page in files.getlist("page[]")]
         if not pages:
             abort(400, description="Files array with name `page[]` is empty.")
+        set_request_log('pages', len(pages))
         config = {
             'NameTag': prepare_filter('NameTag'),
             'UDPipe': prepare_filter('UDPipe'),
             'ALTO': prepare_filter('ALTO')
         }
-        document = generate_tei_document(request.files.get('header'), pages, config)
-        validate(document, app.logger)
+        if prepare_flag('stream'):
+            # uploaded files are closed together with the request, the streamed response outlives it
+            pages = [FileStorage(spool(page.stream), page.filename) for page in pages]
+            # the document is never held in memory, so it is not validated
+            chunks = stream_tei_document(header, pages, config, not prepare_flag('compact'))
+            return Response(stream_with_context(chunks), mimetype='application/xml')
+        document = generate_tei_document(header, pages, config, MERGE_WORKERS)
+        validate_document(document)
         return xml_response(document)
 
 
+@merge_space.route('/append')
+@merge_space.expect(append_parser)
+class Append(Resource):
+    @merge_space.response(200, 'Stránky úspešne pridané. TEI dokument vrátený v response.')
+    @merge_space.doc(description='Pridanie stránok na koniec dokumentu vytvoreného spojením + prípadne filtrovanie '
+                                 'obsahu. Existujúce stránky nie sú znovu spracované.')
+    def post(self):
+        with stage('read'):
+            files = request.files
+        if 'document' not in files:
+            abort(400, description="A file with name `document` does not found in the form data.")
+        pages = [decompress_upload(page) for page in files.getlist("page[]")]
+        if not pages:
+            abort(400, description="Files array with name `page[]` is empty.")
+        set_request_log('pages', len(pages))
+        config = {
+            'NameTag': prepare_filter('NameTag'),
+            'UDPipe': prepare_filter('UDPipe'),
+            'ALTO': prepare_filter('ALTO')
+        }
+        # uploaded files are closed together with the request, the streamed response outlives it
+        document = spool(decompress_upload(files.get('document')).stream)
+        pages = [FileStorage(spool(page.stream), page.filename) for page in pages]
+        chunks = append_tei_document(document, pages, config)
+        return Response(stream_with_context(close_after(chunks, document)), mimetype='application/xml')
+
+
+@merge_space.route('/jobs')
+@merge_space.expect(job_parser)
+@merge_space.param('compact', COMPACT_HELP, _in='query', type='boolean')
+class MergeJobs(Resource):
+    @merge_space.response(202, 'Spojenie zaradené na spracovanie. Stav úlohy vrátený v response.')
+    @merge_space.doc(description='Spojenie hlavičky so stránkami + prípadne filtrovanie obsahu na pozadí. Stav úlohy '
+                                 'je dostupný na `GET /merge/jobs/{id}`, dokument na `GET /merge/jobs/{id}/result`.')
+    def post(self):
+        with stage('read'):
+            files = request.files
+        if 'header' not in files:
+            abort(400, description="A file with name `header` does not found in the form data.")
+        header = decompress_upload(files.get('header'))
+        pages = [decompress_upload(page) for page in files.getlist("page[]")]
+        if not pages:
+            abort(400, description="Files array with name `page[]` is empty.")
+        set_request_log('pages', len(pages))
+        config = {
+            'NameTag': prepare_filter('NameTag'),
+            'UDPipe': prepare_filter('UDPipe'),
+            'ALTO': prepare_filter('ALTO')
+        }
+        status = merge_jobs.submit(header, pages, config, not prepare_flag('compact'))
+        response = json_response(job_status(status), 202)
+        response.headers['Location'] = url_for('api.merge_merge_job', job_id=status['id'])
+        return response
+
+
+@merge_space.route('/jobs/<string:job_id>')
+class MergeJob(Resource):
+    @merge_space.response(200, 'Stav úlohy: `queued`, `running`, `done` alebo `failed`, počet spracovaných stránok.')
+    @merge_space.response(404, 'Úloha neexistuje.')
+    def get(self, job_id):
+        status = merge_jobs.status(job_id)
+        if status is None:
+            abort(404, description="Job `%s` does not exist." % job_id)
+        return json_response(job_status(status))
+
+
+@merge_space.route('/jobs/<string:job_id>/result')
+class MergeJobResult(Resource):
+    @merge_space.response(200, 'TEI dokument vrátený v response.')
+    @merge_space.response(404, 'Úloha neexistuje.')
+    @merge_space.response(409, 'Úloha ešte nie je dokončená alebo zlyhala.')
+    def get(self, job_id):
+        status = merge_jobs.status(job_id)
+        if status is None:
+            abort(404, description="Job `%s` does not exist." % job_id)
+        if status['status'] != 'done':
+            abort(409, description="Job `%s` is %s." % (job_id, status['status']))
+        return send_file(merge_jobs.result_path(job_id), mimetype='application/xml')
+
+
+def job_status(status: dict) -> dict:
+    """Status of a merge job returned to clients"""
+    status = {key: value for key, value in status.items() if key != 'pid'}
+    status['result'] = url_for('api.merge_merge_job_result', job_id=status['id']) if status['status'] == 'done' \
+        else None
+    return status
+
+
 @convert_space.route('/header')
+@convert_space.param('compact', COMPACT_HELP, _in='query', type='boolean')
 class Header(Resource):
     @convert_space.expect(generate_header_model(api))
     @convert_space.response(200, 'Konverzia úspešne prebehal. XML hlavičky vrátené v response.')
     @convert_space.doc(description='Konverzia JSON objektu hlavičky z Kramerius+ do TEI hlavičky.')
     def post(self):
-        return xml_response(generate_tei_header(request.get_json(True)))
+        return xml_response(generate_tei_header(read_json()))
 
 
 @convert_space.route('/page')
+@convert_space.param('compact', COMPACT_HELP, _in='query', type='boolean')
+@convert_space.param('format', PAGE_FORMAT_HELP, _in='query', enum=['xml', 'binary'])
 class Page(Resource):
     @convert_space.expect(generate_page_model(api))
     @convert_space.response(200, 'Konverzia úspešne prebehal. XML stránky vrátená v response.')
     @convert_space.doc(description='Konverzia JSON objektu stránky z Kramerius+ do TEI elementu stránky.')
     def post(self):
-        return xml_response(generate_tei_page(request.get_json(True)))
+        if page_cache is None:
+            # the tokens are read while the page is converted, the page cache needs the whole page for its key
+            page = convert_tei_page(read_page(request.stream))
+        else:
+            page = convert_tei_page(read_json())
+        if request.args.get('format', 'xml') == 'binary':
+            with stage('serialize'):
+                return Response(encode_element(page), mimetype=BINARY_MIMETYPE)
+        return xml_response(page)
+
+
+@convert_space.route('/pages')
+@convert_space.param('compact', COMPACT_HELP, _in='query', type='boolean')
+@convert_space.param('format', PAGES_FORMAT_HELP, _in='query', enum=['xml', 'ndjson'])
+class Pages(Resource):
+    @convert_space.expect(generate_pages_model(api))
+    @convert_space.response(200, 'Konverzia prebehla. Stránky, prípadne chyby jednotlivých stránok, vrátené v '
+                                 'response.')
+    @convert_space.doc(description='Konverzia poľa JSON objektov stránok z Kramerius+ do TEI elementov stránok.')
+    def post(self):
+        if is_ndjson():
+            pages = count_pages(read_ndjson(request.stream))
+        else:
+            pages = read_json()
+            if not isinstance(pages, list):
+                abort(400, description="An array of pages is expected.")
+            set_request_log('pages', len(pages))
+        results = generate_tei_pages(pages)
+        pretty = not prepare_flag('compact')
+        if request.args.get('format', 'xml') == 'ndjson':
+            return Response(stream_with_context(stream_pages_ndjson(results, pretty)), mimetype='application/x-ndjson')
+        return Response(stream_with_context(stream_pages_xml(results, pretty)), mimetype='application/xml')
+
+
+@convert_space.route('/document')
+@convert_space.param('compact', COMPACT_HELP, _in='query', type='boolean')
+class Document(Resource):
+    @convert_space.expect(generate_document_model(api))
+    @convert_space.response(200, 'Konverzia úspešne prebehla. TEI dokument vrátený v response.')
+    @convert_space.doc(description='Konverzia JSON objektov hlavičky a stránok z Kramerius+ priamo do TEI dokumentu '
+                                   '+ prípadne filtrovanie obsahu.')
+    def post(self):
+        data = read_json()
+        if not isinstance(data, dict) or not isinstance(data.get('header'), dict):
+            abort(400, description="Attribute `header` is required.")
+        if not isinstance(data.get('pages'), list) or not data['pages']:
+            abort(400, description="Array `pages` is empty.")
+        set_request_log('pages', len(data['pages']))
+        config = {
+            'NameTag': prepare_filter('NameTag', data),
+            'UDPipe': prepare_filter('UDPipe', data),
+            'ALTO': prepare_filter('ALTO', data)
+        }
+        document = generate_tei_document_from_json(data['header'], data['pages'], config)
+        validate_document(document)
+        return xml_response(document)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,197 @@
+"""
+Benchmark of the conversion, merge, validation and serialization of synthetic documents
+
+The documents are made of copies of the fixture page in `examples`, so they have its NameTag and ALTO density. The
+`from_json_distinct` stage converts copies whose words and token ranges differ on every page, as in real documents.
+Every document size is measured in a new process, the peak RSS is the peak of that process and every stage reports
+how much it raised it.
+
+    python benchmark.py --pages 1 10 100 --repeat 3 --output results.json
+    python benchmark.py --pages 1 10 100 --compare results.json
+"""
+import argparse
+import json
+import os
+import platform
+import re
+import resource
+import sys
+import tracemalloc
+from concurrent.futures import ProcessPoolExecutor
+from copy import deepcopy
+from datetime import datetime
+from io import BytesIO
+from multiprocessing import get_context
+from time import perf_counter
+from typing import Callable, List
+from werkzeug.datastructures import FileStorage
+from converter import generate_tei_header, generate_tei_page, generate_tei_document, generate_tei_document_from_json, \
+    header_cache
+from info import APP_VERSION
+from settings import BASE_DIR
+from utils import prettify, validate, schema_cache
+
+HEADER_FILE = os.path.join(BASE_DIR, "examples", "header.json")
+PAGE_FILE = os.path.join(BASE_DIR, "examples", "page.json")
+STAGES = ("header", "page", "from_json", "from_json_distinct", "document", "validate", "prettify")
+
+
+def synthetic_pages(count: int, distinct: bool = False) -> List[dict]:
+    """
+    Copies of the fixture page with unique ids, the tokens are shared as the conversion does not change them
+
+    :param distinct: copy the tokens with the content and the token range of the misc unique to every page
+    """
+    with open(PAGE_FILE, encoding="utf-8") as page_file:
+        page = json.load(page_file)
+    if not distinct:
+        return [dict(page, id="uuid:benchmark-%05d" % index, index=index) for index in range(count)]
+    return [dict(page, id="uuid:benchmark-%05d" % index, index=index,
+                 tokens=[distinct_token(token, index) for token in page["tokens"]]) for index in range(count)]
+
+
+def distinct_token(token: dict, index: int) -> dict:
+    metadata = token["linguisticMetadata"]
+    misc = re.sub(r"TokenRange=(\d+):(\d+)",
+                  lambda match: "TokenRange=%d:%d" % (int(match[1]) + 10000 * index, int(match[2]) + 10000 * index),
+                  metadata.get("misc", ""))
+    return dict(token, content="%s%d" % (token["content"], index), linguisticMetadata=dict(metadata, misc=misc))
+
+
+def peak_rss() -> int:
+    """Peak resident set size of this process in kB"""
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return usage // 1024 if sys.platform == "darwin" else usage
+
+
+def measure(stage: Callable, repeat: int) -> dict:
+    """
+    Times of the runs of a stage and the growth of the peak RSS of the process during them
+
+    The peak RSS only grows, a stage which fits in the memory used by the previous stages does not raise it, so the
+    growth is a lower bound of the memory used by the stage.
+    """
+    times = []
+    rss_before = peak_rss()
+    for _ in range(repeat):
+        start = perf_counter()
+        stage()
+        times.append(perf_counter() - start)
+    return {"seconds": min(times), "mean_seconds": sum(times) / len(times),
+            "peak_rss_growth_kb": peak_rss() - rss_before}
+
+
+def measure_allocations(stage: Callable) -> dict:
+    """Peak memory allocated by a stage and the memory and number of blocks retained by its result"""
+    tracemalloc.start()
+    try:
+        result = stage()
+        retained, peak = tracemalloc.get_traced_memory()
+        blocks = sum(stat.count for stat in tracemalloc.take_snapshot().statistics("filename"))
+    finally:
+        tracemalloc.stop()
+    del result
+    return {"peak_bytes": peak, "retained_bytes": retained, "retained_blocks": blocks}
+
+
+def run_document(page_count: int, repeat: int, allocations: bool) -> dict:
+    """Measure all stages for a document of `page_count` pages"""
+    with open(HEADER_FILE, encoding="utf-8") as header_file:
+        header = json.load(header_file)
+    pages = synthetic_pages(page_count)
+    distinct_pages = synthetic_pages(page_count, distinct=True)
+    tokens = sum(len(page["tokens"]) for page in pages)
+    header_xml = prettify(generate_tei_header(deepcopy(header))).encode("utf-8")
+    page_xml = [prettify(generate_tei_page(page)).encode("utf-8") for page in pages]
+    document = generate_tei_document(FileStorage(BytesIO(header_xml)), [FileStorage(BytesIO(x)) for x in page_xml])
+    # the schema is compiled once per worker, it is not part of the validation
+    schema_cache.load()
+
+    # the conversion adds to the lists of the header, every run converts a new copy
+    def header_stage():
+        header_cache.clear()
+        return generate_tei_header(deepcopy(header))
+
+    def page_stage():
+        return [generate_tei_page(page) for page in pages]
+
+    def document_stage():
+        return generate_tei_document(FileStorage(BytesIO(header_xml)), [FileStorage(BytesIO(x)) for x in page_xml])
+
+    stages = {
+        "header": header_stage,
+        "page": page_stage,
+        "from_json": lambda: generate_tei_document_from_json(deepcopy(header), pages),
+        "from_json_distinct": lambda: generate_tei_document_from_json(deepcopy(header), distinct_pages),
+        "document": document_stage,
+        "validate": lambda: validate(document),
+        "prettify": lambda: prettify(document)
+    }
+    results = {}
+    for name in STAGES:
+        results[name] = measure(stages[name], repeat)
+        if name != "header":
+            results[name]["tokens_per_second"] = tokens / results[name]["seconds"]
+        if allocations:
+            results[name]["allocations"] = measure_allocations(stages[name])
+    return {"pages": page_count, "tokens": tokens, "peak_rss_kb": peak_rss(), "stages": results}
+
+
+def run(page_counts: List[int], repeat: int, allocations: bool) -> dict:
+    documents = []
+    for page_count in page_counts:
+        with ProcessPoolExecutor(max_workers=1, mp_context=get_context("spawn")) as executor:
+            documents.append(executor.submit(run_document, page_count, repeat, allocations).result())
+    return {
+        "version": APP_VERSION,
+        "date": datetime.now().strftime('%Y-%m-%dT%H:%M:%S'),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "repeat": repeat,
+        "documents": documents
+    }
+
+
+def compare(results: dict, baseline: dict) -> List[str]:
+    """Lines with the ratio of the time of each stage to the time in the baseline, above 1 is slower"""
+    baseline_documents = {document["pages"]: document for document in baseline["documents"]}
+    lines = []
+    for document in results["documents"]:
+        if document["pages"] not in baseline_documents:
+            continue
+        base_stages = baseline_documents[document["pages"]]["stages"]
+        for name, stage in document["stages"].items():
+            if name in base_stages:
+                ratio = stage["seconds"] / base_stages[name]["seconds"]
+                lines.append("%6d pages %-10s %10.4f s %6.2fx" % (document["pages"], name, stage["seconds"], ratio))
+    return lines
+
+
+def main(argv: List[str] = None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--pages", type=int, nargs="+", default=[1, 10, 100],
+                        help="numbers of pages of the measured documents, 1 to 10000")
+    parser.add_argument("--repeat", type=int, default=3, help="runs of each stage, the fastest one is reported")
+    parser.add_argument("--allocations", action="store_true",
+                        help="measure memory allocated by each stage with tracemalloc in an extra run")
+    parser.add_argument("--output", help="file the JSON results are written to, standard output if not set")
+    parser.add_argument("--compare", help="JSON results of a previous run to compare the times with")
+    args = parser.parse_args(argv)
+    if any(count < 1 or count > 10000 for count in args.pages):
+        parser.error("the number of pages must be between 1 and 10000")
+
+    results = run(args.pages, max(1, args.repeat), args.allocations)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as output:
+            json.dump(results, output, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as baseline:
+            print("\n".join(compare(results, json.load(baseline))), file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
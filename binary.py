@@ -0,0 +1,136 @@
+"""
+Compact binary representation of TEI elements
+
+Pages converted by `POST /convert/page?format=binary` can be uploaded to `/merge` in this format instead of XML.
+The client does not need to read it. The format is
+
+    magic `TEIB`, version byte, index width byte (2 or 4), zlib compressed body
+
+and the body is
+
+    uint32 length of the string table, string table, array of indices
+
+The string table holds all tags, attribute names, attribute values and texts of the tree once, encoded in UTF-8 and
+separated by NUL characters, which can not appear in XML. The array describes the elements in document order,
+each of them as
+
+    tag, number of children, text, tail, number of attributes, (attribute name, attribute value) * number of attributes
+
+where the strings are indices to the string table counted from 1, 0 stands for a missing text or tail. All numbers
+are little endian.
+"""
+import sys
+import zlib
+from array import array
+from typing import List, Optional
+from xml.etree.ElementTree import Element, SubElement
+from werkzeug.exceptions import BadRequest
+from settings import MAX_CONTENT_LENGTH
+
+BINARY_MAGIC = b"TEIB"
+BINARY_VERSION = 1
+BINARY_MIMETYPE = "application/octet-stream"
+HEADER_SIZE = len(BINARY_MAGIC) + 2
+TYPECODES = {2: "H", 4: "I" if array("I").itemsize == 4 else "L"}
+
+
+def is_binary(data: bytes) -> bool:
+    return data[:len(BINARY_MAGIC)] == BINARY_MAGIC
+
+
+def encode_element(elem: Element) -> bytes:
+    """Encode an element with all its descendants in the binary format"""
+    strings = {}
+    indices = []
+
+    def index(value: Optional[str]) -> int:
+        if value is None:
+            return 0
+        i = strings.get(value)
+        if i is None:
+            i = strings[value] = len(strings) + 1
+        return i
+
+    def encode(element: Element):
+        indices.extend((index(element.tag), len(element), index(element.text), index(element.tail),
+                        len(element.attrib)))
+        for name, value in element.attrib.items():
+            indices.append(index(name))
+            indices.append(index(value))
+        for sub in element:
+            encode(sub)
+
+    encode(elem)
+    width = 2 if max(indices) <= 0xFFFF else 4
+    table = "\0".join(strings).encode("utf-8")
+    values = array(TYPECODES[width], indices)
+    if sys.byteorder == "big":
+        values.byteswap()
+    body = len(table).to_bytes(4, "little") + table + values.tobytes()
+    return BINARY_MAGIC + bytes((BINARY_VERSION, width)) + zlib.compress(body)
+
+
+def decode_element(data: bytes) -> Element:
+    """
+    Decode an element encoded by `encode_element`
+
+    :raises BadRequest: if the data are not a valid element in the binary format
+    """
+    try:
+        if not is_binary(data) or data[len(BINARY_MAGIC)] != BINARY_VERSION:
+            raise ValueError("unknown format or version")
+        width = data[len(BINARY_MAGIC) + 1]
+        decompressor = zlib.decompressobj()
+        body = decompressor.decompress(data[HEADER_SIZE:], MAX_CONTENT_LENGTH or 0)
+        if decompressor.unconsumed_tail:
+            raise ValueError("the page is too large")
+        table_size = int.from_bytes(body[:4], "little")
+        strings = [None] + body[4:4 + table_size].decode("utf-8").split("\0")
+        values = array(TYPECODES[width])
+        values.frombytes(body[4 + table_size:])
+        if sys.byteorder == "big":
+            values.byteswap()
+        return build_element(values.tolist(), strings)
+    except (ValueError, KeyError, IndexError, TypeError, zlib.error) as e:
+        raise BadRequest(description="Invalid binary page: %s" % e)
+
+
+def build_element(indices: List[int], strings: List[Optional[str]]) -> Element:
+    root = None
+    # open elements with the number of their children not built yet
+    stack = []
+    position = 0
+    end = len(indices)
+    while position < end:
+        tag, children, text, tail, attributes = indices[position:position + 5]
+        position += 5
+        if not tag:
+            raise ValueError("missing tag")
+        attrib = {}
+        for _ in range(attributes):
+            name, value = indices[position], indices[position + 1]
+            if not name or not value:
+                raise ValueError("missing attribute name or value")
+            attrib[strings[name]] = strings[value]
+            position += 2
+        if stack:
+            parent = stack[-1]
+            element = SubElement(parent[0], strings[tag], attrib)
+            parent[1] -= 1
+        elif root is None:
+            element = root = Element(strings[tag], attrib)
+        else:
+            raise ValueError("more than one root element")
+        if text:
+            element.text = strings[text]
+        if tail:
+            element.tail = strings[tail]
+        if children:
+            stack.append([element, children])
+        else:
+            while stack and not stack[-1][1]:
+                stack.pop()
+    if root is None or stack:
+        raise ValueError("the data end inside an element")
+    return root
+
@@ -0,0 +1,513 @@
+"""
+Bulk conversion of Kramerius+ exports to TEI documents without the HTTP service
+
+A document is a directory with a `header.json` file and one JSON file per page, in the natural order of their names,
+a JSON file with the `header` and `pages` of the document, as the body of `/tei/convert/document`, or an NDJSON file
+with the header on the first line and one page per line. The inputs are documents, directories searched for documents
+and zip or tar archives holding documents in the same layout. Every document is written to the output directory as
+`<path of the document>.xml`.
+
+    python bulk.py exports/ collection.tar.gz --output tei/ --workers 4
+    python bulk.py exports/ --output tei/ --name-tag p,g --alto "" --compact
+
+Finished documents are recorded in a checkpoint file in the output directory. A document whose source and options
+have not changed since it was recorded is skipped, so an interrupted run continues where it stopped when it is
+started again.
+"""
+import argparse
+import json
+import logging
+import lzma
+import os
+import re
+import sys
+import tarfile
+import zipfile
+import zlib
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import datetime
+from time import perf_counter
+from typing import BinaryIO, Iterator, Iterable, List, Optional
+from werkzeug.exceptions import HTTPException
+from converter import DEFAULT_CONFIG, generate_tei_document_from_json
+from info import APP_VERSION
+from json_stream import read_page
+from tokens import PageTokens, InternTable
+from utils import iter_serialize, prepare_filter, read_ndjson, validate
+
+HEADER_FILE = "header.json"
+CHECKPOINT_FILE = ".tei-bulk-checkpoint.jsonl"
+DOCUMENT_EXTENSIONS = (".json", ".ndjson", ".jsonl")
+ARCHIVE_EXTENSIONS = (".zip", ".tar", ".tar.gz", ".tgz", ".tar.bz2", ".tbz2", ".tar.xz", ".txz")
+FILTERS = {"NameTag": "name_tag", "UDPipe": "udpipe", "ALTO": "alto"}
+NUMBER = re.compile(r"(\d+)")
+CURRENT_DIRECTORY = re.compile(r"^(\./)+")
+DRIVE = re.compile(r"^[A-Za-z]:")
+# Errors of reading broken documents and archives, a document failing with them does not stop the run
+READ_ERRORS = (OSError, EOFError, ValueError, TypeError, KeyError, AttributeError, tarfile.TarError,
+               zipfile.BadZipFile, zlib.error, lzma.LZMAError)
+
+logger = logging.getLogger("bulk")
+
+
+def natural_key(name: str) -> list:
+    """Sort key of a file name with its numbers compared by value, `page-2` sorts before `page-10`"""
+    return [int(part) if part.isdigit() else part for part in NUMBER.split(name)]
+
+
+def strip_extension(name: str, extensions: Iterable[str]) -> str:
+    for extension in extensions:
+        if name.lower().endswith(extension):
+            return name[:-len(extension)]
+    return name
+
+
+def is_archive(name: str) -> bool:
+    return name.lower().endswith(ARCHIVE_EXTENSIONS)
+
+
+def is_document_file(name: str) -> bool:
+    return name.lower().endswith(DOCUMENT_EXTENSIONS)
+
+
+def is_relative_name(name: str) -> bool:
+    """Check that a member name of an archive is a relative path without `..`, which stays in the output directory"""
+    parts = name.replace("\\", "/").split("/")
+    return name[:1] not in ("/", "\\") and not DRIVE.match(name) and ".." not in parts
+
+
+def document_output_path(output: str, name: str) -> str:
+    """
+    Path of the TEI document of a document in the output directory
+
+    :param output: output directory
+    :param name: name of the document, a path separated by `/`, see `group_documents`
+    :returns: path of the `.xml` file
+    :raises ValueError: if the name is absolute, contains `..` or the path leaves the output directory
+    """
+    if not is_relative_name(name):
+        raise ValueError("document name `%s` leaves the output directory" % name)
+    parts = [part for part in name.replace("\\", "/").split("/") if part not in ("", ".")]
+    if not parts:
+        raise ValueError("document name `%s` is empty" % name)
+    path = os.path.join(output, *parts) + ".xml"
+    root = os.path.realpath(output)
+    if os.path.commonpath([root, os.path.realpath(path)]) != root:
+        raise ValueError("document name `%s` leaves the output directory" % name)
+    return path
+
+
+def group_documents(files: List[str], prefix: str, root: str, signature: Optional[list]) -> List[dict]:
+    """
+    Documents made of the given files of a directory tree or an archive
+
+    :param files: paths of the files relative to `root`, separated by `/`
+    :param prefix: path of `root` in the output directory
+    :param root: directory or archive the files are read from
+    :param signature: size and modification time of an archive, None to use the files of each document
+    :returns: specifications of the documents, read by `convert_document`
+    """
+    directories = {}
+    for name in files:
+        if not is_relative_name(name):
+            logger.warning("Skipping `%s` in `%s`, the path leaves the output directory", name, root)
+            continue
+        directory, _, file_name = name.rpartition("/")
+        directories.setdefault(directory, []).append(file_name)
+
+    def output_name(path: str) -> str:
+        return "/".join(part for part in (prefix, path) if part)
+
+    documents = []
+    for directory, names in sorted(directories.items()):
+        member = (directory + "/") if directory else ""
+        if HEADER_FILE in names:
+            pages = sorted((name for name in names if name != HEADER_FILE and name.lower().endswith(".json")),
+                           key=natural_key)
+            documents.append({
+                "name": output_name(directory) or os.path.basename(os.path.abspath(root)),
+                "root": root,
+                "header": member + HEADER_FILE,
+                "pages": [member + name for name in pages],
+                "signature": signature
+            })
+            continue
+        for name in sorted((name for name in names if is_document_file(name)), key=natural_key):
+            documents.append({
+                "name": output_name(member + strip_extension(name, DOCUMENT_EXTENSIONS)),
+                "root": root,
+                "document": member + name,
+                "signature": signature
+            })
+    return documents
+
+
+def find_documents(path: str) -> List[dict]:
+    """Documents of an input path, a document file, a directory or an archive"""
+    if os.path.isdir(path):
+        files, archives = [], []
+        for directory, subdirectories, names in os.walk(path):
+            subdirectories.sort()
+            relative = os.path.relpath(directory, path).replace(os.sep, "/")
+            for name in names:
+                name = name if relative == "." else relative + "/" + name
+                (archives if is_archive(name) else files).append(name)
+        documents = group_documents(files, "", path, None)
+        for name in archives:
+            documents.extend(find_archive_documents(os.path.join(path, name),
+                                                    strip_extension(name, ARCHIVE_EXTENSIONS)))
+        return documents
+    if is_archive(path):
+        return find_archive_documents(path, strip_extension(os.path.basename(path), ARCHIVE_EXTENSIONS))
+    name = strip_extension(os.path.basename(path), DOCUMENT_EXTENSIONS)
+    return [{"name": name, "root": os.path.dirname(os.path.abspath(path)), "document": os.path.basename(path),
+             "signature": None}]
+
+
+def is_checkpoint(document: dict, checkpoint_path: str) -> bool:
+    """Check whether a document is the checkpoint file, which is found in the inputs if they contain the output"""
+    if "document" not in document or document["signature"] is not None:
+        return False
+    path = os.path.join(document["root"], *document["document"].split("/"))
+    return os.path.realpath(path) == os.path.realpath(checkpoint_path)
+
+
+def find_archive_documents(path: str, prefix: str) -> List[dict]:
+    """Documents of an archive, an archive which can not be read is one document with the error"""
+    stat = os.stat(path)
+    try:
+        with Container(path) as container:
+            files = container.files()
+    except READ_ERRORS as e:
+        return [{"name": prefix, "root": path, "signature": None, "error": "%s: %s" % (type(e).__name__, e)}]
+    return group_documents(files, prefix, path, [stat.st_size, stat.st_mtime_ns])
+
+
+def source_signature(document: dict) -> list:
+    """Size and modification time of the files of a document, changed when any of them changes"""
+    if document["signature"] is not None:
+        return document["signature"]
+    size, modified = 0, 0
+    names = ([document["header"]] + document["pages"]) if "header" in document else [document["document"]]
+    for name in names:
+        stat = os.stat(os.path.join(document["root"], *name.split("/")))
+        size += stat.st_size
+        modified = max(modified, stat.st_mtime_ns)
+    return [size, modified]
+
+
+class Container:
+    """Files of a document read from a directory, a zip or a tar archive"""
+
+    def __init__(self, root: str):
+        self.root = root
+        self.archive = None
+        # archive members by their names without a leading `./`
+        self.members = {}
+        if os.path.isdir(root):
+            return
+        if root.lower().endswith(".zip"):
+            self.archive = zipfile.ZipFile(root)
+            members = [info for info in self.archive.infolist() if not info.is_dir()]
+            names = [info.filename for info in members]
+        else:
+            # members stored in the order of their names, as written by tar, are read sequentially
+            self.archive = tarfile.open(root, "r:*")
+            members = [member for member in self.archive.getmembers() if member.isfile()]
+            names = [member.name for member in members]
+        self.members = {CURRENT_DIRECTORY.sub("", name): member for name, member in zip(names, members)}
+
+    def files(self) -> List[str]:
+        return list(self.members)
+
+    def open(self, name: str) -> BinaryIO:
+        if self.archive is None:
+            return open(os.path.join(self.root, *name.split("/")), "rb")
+        if isinstance(self.archive, zipfile.ZipFile):
+            return self.archive.open(self.members[name])
+        return self.archive.extractfile(self.members[name])
+
+    def close(self):
+        if self.archive is not None:
+            self.archive.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+_container = None
+
+
+def get_container(root: str) -> Container:
+    """
+    Container of the files of a document, the last archive is kept open by the process
+
+    The documents of an archive are usually converted one after another, so its index is read only once.
+    """
+    global _container
+    if _container is None or _container.root != root:
+        if _container is not None:
+            _container.close()
+        _container = Container(root)
+    return _container
+
+
+def read_pages(container: Container, names: List[str], counts: dict, intern: InternTable) -> Iterator[dict]:
+    """
+    Read the page files one by one as they are converted, see `json_stream.read_page`, and count them in `counts`
+    """
+    for name in names:
+        with container.open(name) as stream:
+            page = read_page(stream, intern)
+        counts["pages"] += 1
+        if isinstance(page.get("tokens"), PageTokens):
+            counts["tokens"] += len(page["tokens"])
+        yield page
+
+
+def count_pages(pages: Iterable, counts: dict) -> Iterator:
+    for page in pages:
+        if isinstance(page, HTTPException):
+            raise page
+        if isinstance(page, dict) and "tokens" in page:
+            page["tokens"] = count_tokens(page["tokens"], counts)
+        counts["pages"] += 1
+        yield page
+
+
+def count_tokens(tokens: Iterable, counts: dict) -> Iterator:
+    for token in tokens:
+        counts["tokens"] += 1
+        yield token
+
+
+def read_document(container: Container, document: dict, counts: dict,
+                  intern: InternTable) -> (dict, Iterable[dict]):
+    """Header and pages of a document, the pages are read while they are iterated"""
+    if "header" in document:
+        with container.open(document["header"]) as stream:
+            header = json.load(stream)
+        return header, read_pages(container, document["pages"], counts, intern)
+    stream = container.open(document["document"])
+    if document["document"].lower().endswith(".json"):
+        with stream:
+            data = json.load(stream)
+        if not isinstance(data, dict) or not isinstance(data.get("header"), dict):
+            raise ValueError("Attribute `header` is required.")
+        if not isinstance(data.get("pages"), list):
+            raise ValueError("Array `pages` is required.")
+        return data["header"], count_pages(data["pages"], counts)
+    lines = read_ndjson(stream)
+    header = next(lines, None)
+    if not isinstance(header, dict):
+        stream.close()
+        raise ValueError("The first line must be the header object.")
+    return header, close_stream(count_pages(lines, counts), stream)
+
+
+def close_stream(items: Iterator, stream: BinaryIO) -> Iterator:
+    with stream:
+        yield from items
+
+
+def convert_document(document: dict, output_path: str, config: dict, pretty: bool, check: bool) -> dict:
+    """
+    Convert a document and write it to `output_path`, the output is replaced only once it is complete
+
+    :param document: specification of the document, see `group_documents`
+    :param check: validate the document against the schema
+    :returns: result with the numbers of pages and tokens, the time and the validity or the error
+    """
+    start = perf_counter()
+    counts = {"pages": 0, "tokens": 0}
+    result = {"name": document["name"], "error": None, "valid": None}
+    try:
+        intern = InternTable()
+        header, pages = read_document(get_container(document["root"]), document, counts, intern)
+        tei = generate_tei_document_from_json(header, pages, config, intern)
+        if check:
+            result["valid"] = validate(tei, logger)
+        os.makedirs(os.path.dirname(output_path), exist_ok=True)
+        with open(output_path + ".part", "wb") as output:
+            for chunk in iter_serialize(tei, pretty):
+                output.write(chunk)
+        os.replace(output_path + ".part", output_path)
+        result["output_size"] = os.path.getsize(output_path)
+    except HTTPException as e:
+        result["error"] = e.description
+    except READ_ERRORS as e:
+        result["error"] = "%s: %s" % (type(e).__name__, e)
+    result.update(counts, seconds=perf_counter() - start)
+    return result
+
+
+class Checkpoint:
+    """
+    Documents finished by previous runs, one JSON line per document appended to `path`
+
+    A document is up to date if its source and the options have not changed and its output has the recorded size.
+    """
+
+    def __init__(self, path: str, options: dict):
+        self.path = path
+        self.options = options
+        self.entries = {}
+        try:
+            with open(path, encoding="utf-8") as checkpoint:
+                for line in checkpoint:
+                    try:
+                        entry = json.loads(line)
+                        self.entries[entry["name"]] = entry
+                    except (ValueError, KeyError, TypeError):
+                        # a line cut off by an interrupted run
+                        continue
+        except FileNotFoundError:
+            pass
+        self._file = None
+
+    def is_done(self, name: str, signature: list, output_path: str) -> bool:
+        entry = self.entries.get(name)
+        if entry is None or entry.get("source") != signature or entry.get("options") != self.options:
+            return False
+        try:
+            return os.path.getsize(output_path) == entry.get("output_size")
+        except OSError:
+            return False
+
+    def record(self, result: dict, signature: list):
+        if self._file is None:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            self._file = open(self.path, "a", encoding="utf-8")
+        entry = {
+            "name": result["name"],
+            "source": signature,
+            "options": self.options,
+            "output_size": result["output_size"],
+            "finished": datetime.now().strftime('%Y-%m-%dT%H:%M:%S')
+        }
+        self._file.write(json.dumps(entry) + "\n")
+        self._file.flush()
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+
+
+class Progress:
+    """Progress of the run written to standard error, with the throughput since the start"""
+
+    def __init__(self, total: int):
+        self.total = total
+        self.done = 0
+        self.failed = 0
+        self.pages = 0
+        self.tokens = 0
+        self.start = perf_counter()
+
+    def update(self, result: dict):
+        self.done += 1
+        self.pages += result["pages"]
+        self.tokens += result["tokens"]
+        if result["error"] is not None:
+            self.failed += 1
+            status = "FAILED %s" % result["error"]
+        elif result["valid"] is False:
+            status = "INVALID"
+        else:
+            status = "%d pages %.2f s" % (result["pages"], result["seconds"])
+        elapsed = max(perf_counter() - self.start, 1e-9)
+        print("[%d/%d] %s: %s | %.1f docs/s %.1f pages/s %.0f tokens/s"
+              % (self.done, self.total, result["name"], status, self.done / elapsed, self.pages / elapsed,
+                 self.tokens / elapsed), file=sys.stderr)
+
+    def summary(self, skipped: int) -> str:
+        elapsed = perf_counter() - self.start
+        return "%d documents converted, %d failed, %d up to date, %d pages, %d tokens in %.1f s" \
+               % (self.done - self.failed, self.failed, skipped, self.pages, self.tokens, elapsed)
+
+
+def prepare_options(args: argparse.Namespace) -> dict:
+    """Configuration of the filters, same as the form fields of `/tei/merge`, and the output format"""
+    source = {name: getattr(args, attribute) for name, attribute in FILTERS.items()
+              if getattr(args, attribute) is not None}
+    config = {name: prepare_filter(name, source) for name in DEFAULT_CONFIG}
+    return {"version": APP_VERSION, "config": config, "pretty": not args.compact}
+
+
+def run(documents: List[dict], output: str, options: dict, checkpoint: Checkpoint, workers: int,
+        check: bool, force: bool) -> int:
+    """Convert the documents which are not up to date, returns the number of failed documents"""
+    pending, rejected = [], []
+    for document in documents:
+        try:
+            if "error" in document:
+                raise ValueError(document["error"])
+            output_path = document_output_path(output, document["name"])
+        except ValueError as e:
+            rejected.append({"name": document["name"], "error": str(e), "valid": None, "pages": 0, "tokens": 0,
+                             "seconds": 0.0})
+            continue
+        signature = source_signature(document)
+        if force or not checkpoint.is_done(document["name"], signature, output_path):
+            pending.append((document, output_path, signature))
+    skipped = len(documents) - len(pending) - len(rejected)
+    progress = Progress(len(pending) + len(rejected))
+    for result in rejected:
+        progress.update(result)
+    arguments = (options["config"], options["pretty"], check)
+
+    def finish(result: dict, signature: list):
+        progress.update(result)
+        if result["error"] is None:
+            checkpoint.record(result, signature)
+
+    if workers <= 1:
+        for document, output_path, signature in pending:
+            finish(convert_document(document, output_path, *arguments), signature)
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = {executor.submit(convert_document, document, output_path, *arguments): signature
+                       for document, output_path, signature in pending}
+            for future in as_completed(futures):
+                finish(future.result(), futures[future])
+    print(progress.summary(skipped), file=sys.stderr)
+    return progress.failed
+
+
+def main(argv: List[str] = None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("inputs", nargs="+", help="documents, directories of documents or zip and tar archives")
+    parser.add_argument("--output", required=True, help="directory the TEI documents are written to")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1,
+                        help="number of documents converted at once by separate processes")
+    parser.add_argument("--name-tag", help="comma separated NameTag categories kept in the documents")
+    parser.add_argument("--udpipe", help="comma separated UDPipe attributes kept in the documents")
+    parser.add_argument("--alto", help="comma separated ALTO attributes kept in the documents")
+    parser.add_argument("--compact", action="store_true", help="write the documents without indentation")
+    parser.add_argument("--validate", action="store_true", help="validate the documents against the schema")
+    parser.add_argument("--checkpoint", help="checkpoint file, `%s` in the output directory if not set"
+                                             % CHECKPOINT_FILE)
+    parser.add_argument("--force", action="store_true", help="convert also the documents which are up to date")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format="%(levelname)s %(message)s")
+
+    checkpoint_path = args.checkpoint or os.path.join(args.output, CHECKPOINT_FILE)
+    documents = []
+    for path in args.inputs:
+        if not os.path.exists(path):
+            parser.error("input `%s` does not exist" % path)
+        documents.extend(document for document in find_documents(path) if not is_checkpoint(document, checkpoint_path))
+    options = prepare_options(args)
+    checkpoint = Checkpoint(checkpoint_path, options)
+    try:
+        failed = run(documents, args.output, options, checkpoint, args.workers, args.validate, args.force)
+    finally:
+        checkpoint.close()
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,149 @@
+"""
+Compressed request and response bodies
+
+Request bodies with `Content-Encoding: gzip` or `zstd` and uploaded files compressed with gzip or zstd are
+decompressed while they are read. Responses are compressed with the best encoding accepted by the client, streamed
+responses chunk by chunk. `zstd` is supported only if the `zstandard` package from the requirements is installed,
+without it only gzip is accepted and used.
+"""
+import zlib
+from gzip import BadGzipFile, GzipFile
+from io import RawIOBase, BufferedReader
+from typing import BinaryIO, Iterable, Iterator, Optional
+from flask import Response
+from werkzeug.datastructures import FileStorage
+from werkzeug.exceptions import BadRequest, RequestEntityTooLarge, UnsupportedMediaType
+from settings import COMPRESSION_LEVEL, ZSTD_LEVEL, COMPRESSION_MIN_SIZE, MAX_CONTENT_LENGTH
+from utils import spool
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Errors of the decompressors raised while corrupt or truncated data are read
+DECOMPRESSION_ERRORS = (BadGzipFile, EOFError, zlib.error) + ((zstandard.ZstdError,) if zstandard is not None else ())
+
+GZIP_MAGIC = b"\x1f\x8b"
+ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+ENCODINGS = ("zstd", "gzip") if zstandard is not None else ("gzip",)
+COMPRESSIBLE_MIMETYPES = ("application/xml", "application/json", "application/x-ndjson", "text/plain", "text/html")
+
+
+class LimitedReader(RawIOBase):
+    """
+    Stream of decompressed data, a body larger than `limit` bytes is rejected with 413 and corrupt compressed data
+    with 400
+    """
+
+    def __init__(self, stream: BinaryIO, limit: Optional[int]):
+        self.stream = stream
+        self.limit = limit
+        self.size = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+        try:
+            data = self.stream.read(len(buffer))
+        except DECOMPRESSION_ERRORS as e:
+            raise BadRequest(description="Invalid compressed data: %s" % e)
+        self.size += len(data)
+        if self.limit is not None and self.size > self.limit:
+            raise RequestEntityTooLarge()
+        buffer[:len(data)] = data
+        return len(data)
+
+
+def decompressing_stream(stream: BinaryIO, encoding: str, limit: Optional[int] = MAX_CONTENT_LENGTH) -> BinaryIO:
+    if encoding == "gzip":
+        decompressed = GzipFile(fileobj=stream, mode="rb")
+    elif encoding == "zstd" and zstandard is not None:
+        decompressed = zstandard.ZstdDecompressor().stream_reader(stream)
+    else:
+        raise UnsupportedMediaType(description="Content encoding `%s` is not supported, use one of: %s."
+                                               % (encoding, ", ".join(ENCODINGS)))
+    return BufferedReader(LimitedReader(decompressed, limit))
+
+
+def decompress_request(environ: dict):
+    """
+    Replace a compressed WSGI input stream with a stream of the decompressed body
+
+    Must be called before the body is read. The length of the decompressed body is not known, so the input is marked
+    as terminated and the size is limited while it is read instead.
+    """
+    encoding = environ.get("HTTP_CONTENT_ENCODING", "").strip().lower()
+    if encoding in ("", "identity"):
+        return
+    environ["wsgi.input"] = decompressing_stream(environ["wsgi.input"], encoding)
+    environ["wsgi.input_terminated"] = True
+    environ.pop("CONTENT_LENGTH", None)
+    del environ["HTTP_CONTENT_ENCODING"]
+
+
+def decompress_upload(file: FileStorage) -> FileStorage:
+    """
+    Decompress an uploaded file compressed with gzip or zstd, recognized by its `Content-Encoding` header or its
+    content, into a seekable temporary file. Other files are returned as they are.
+    """
+    encoding = (file.headers.get("Content-Encoding") or "").strip().lower()
+    if encoding in ("", "identity"):
+        start = file.stream.read(len(ZSTD_MAGIC))
+        file.stream.seek(0)
+        if start[:len(GZIP_MAGIC)] == GZIP_MAGIC:
+            encoding = "gzip"
+        elif start == ZSTD_MAGIC and zstandard is not None:
+            encoding = "zstd"
+        else:
+            return file
+    return FileStorage(spool(decompressing_stream(file.stream, encoding)), file.filename, file.name)
+
+
+def compress_response(response: Response, encoding: str) -> Response:
+    """
+    Compress the body of a response with `gzip` or `zstd`
+
+    Streamed responses are compressed chunk by chunk and every chunk is flushed, so they are still sent as they are
+    produced. Bodies of other responses shorter than `COMPRESSION_MIN_SIZE` are not compressed.
+    """
+    response.vary.add("Accept-Encoding")
+    if response.is_streamed:
+        response.response = compress_chunks(response.response, encoding)
+        response.direct_passthrough = False
+        response.headers.pop("Content-Length", None)
+    else:
+        data = response.get_data()
+        if len(data) < COMPRESSION_MIN_SIZE:
+            return response
+        response.set_data(b"".join(compress_chunks([data], encoding)))
+    response.headers["Content-Encoding"] = encoding
+    # ranges of `send_file` responses are offsets of the uncompressed file, they are not served compressed
+    response.headers.pop("Accept-Ranges", None)
+    return response
+
+
+def compress_chunks(chunks: Iterable[bytes], encoding: str) -> Iterator[bytes]:
+    if encoding == "zstd":
+        compressor = zstandard.ZstdCompressor(level=ZSTD_LEVEL).compressobj()
+        sync_flush = zstandard.COMPRESSOBJ_FLUSH_BLOCK
+    else:
+        compressor = zlib.compressobj(COMPRESSION_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        sync_flush = zlib.Z_SYNC_FLUSH
+    try:
+        for chunk in chunks:
+            if chunk:
+                data = compressor.compress(chunk) + compressor.flush(sync_flush)
+                if data:
+                    yield data
+        yield compressor.flush()
+    finally:
+        if hasattr(chunks, "close"):
+            chunks.close()
+
+
+def is_compressible(response: Response) -> bool:
+    return 200 <= response.status_code < 300 and response.status_code not in (204, 206) and \
+        "Content-Encoding" not in response.headers and "Content-Range" not in response.headers and \
+        response.mimetype in COMPRESSIBLE_MIMETYPES
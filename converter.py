@@ -1,13 +1,92 @@
+import json
+from copy import deepcopy
 from datetime import datetime
-from typing import List
-from xml.etree.ElementTree import Element, SubElement, parse
+from functools import lru_cache
+from hashlib import sha256
+from io import BytesIO, SEEK_CUR, SEEK_END
+from shutil import copyfileobj
+from tempfile import SpooledTemporaryFile
+from concurrent.futures import ProcessPoolExecutor
+from itertools import count, chain, repeat
+from multiprocessing import get_context
+from threading import Lock
+from typing import Any, Callable, List, Iterator, Iterable, Tuple, Union, Optional, BinaryIO
+from xml.etree.ElementTree import Element, SubElement, parse, iterparse
 from werkzeug.datastructures import FileStorage
-from werkzeug.exceptions import abort
+from werkzeug.exceptions import abort, HTTPException, BadRequest
+from binary import BINARY_MAGIC, is_binary, decode_element
 from info import APP_VERSION
-from utils import calendar, month_to_number
+from metrics import stage, timed, record_pages
+from nametag import NAME_TAG_FACTORIES, create_group
+from page_cache import get_cached_page, put_cached_page
+from settings import SPOOL_MAX_SIZE, HEADER_CACHE_SIZE, METRICS_ENABLED
+from tokens import PageTokens, InternTable, ALTO_ATTRIBUTES
+from utils import calendar, XMLStreamWriter, drain, LRUCache
 
+CHUNK_SIZE = 64 * 1024
+# Attributes of the ALTO values of words converted without a configuration
+ALTO_NAMES = tuple("alto-" + attr for attr in ALTO_ATTRIBUTES)
+# NameTag interpretations described in the header
+NAME_TAG_INTERPS = {
+    "a": "ČÍSLA JAKO SOUČÁSTI ADRES",
+    "ah": "číslo popisné",
+    "at": "telefon, fax",
+    "az": "PSČ",
+    "g": "GEOGRAFICKÉ NÁZVY",
+    "gc": "státní útvary",
+    "gh": "vodní útvary",
+    "gl": "přírodní oblasti / útvary",
+    "gq": "části obcí, pomístní názvy",
+    "gr": "menší územní jednotky",
+    "gs": "ulice, náměstí",
+    "gt": "kontinenty",
+    "gu": "obce, hrady a zámky",
+    "g_": "geografický název nespecifikovaného typu / nezařaditelný do ostatních typů",
+    "i": "NÁZVY INSTITUCÍ",
+    "ia": "přednášky, konference, soutěže,...",
+    "ic": "kulturní, vzdělávací a vědecké instituce, sportovní kluby,...",
+    "if": "firmy, koncerny, hotely,...",
+    "io": "státní a mezinárodní instituce, politické strany a hnutí, náboženské skupiny",
+    "i_": "instituce nespecifikovaného typu / nezařaditelné do ostatních typů",
+    "m": "NÁZVY MÉDIÍ",
+    "me": "e-mailové adresy",
+    "mi": "internetové odkazy",
+    "mn": "periodika, redakce, tiskové agentury",
+    "ms": "rozhlasové a televizní stanice",
+    "n": "ČÍSLA SE SPECIFICKÝM VÝZNAMEM",
+    "na": "věk",
+    "nc": "číslo s významem počtu",
+    "nb": "číslo strany, kapitoly, oddílu, obrázku",
+    "no": "číslo s významem pořadí",
+    "ns": "sportovní skóre",
+    "ni": "itemizátor",
+    "n_": "číslo se specifickým významem, jehož typ nebyl vyčleněn jako samostatný / nelze identifikovat",
+    "o": "NÁZVY VĚCÍ",
+    "oa": "kulturní artefakty (knihy, filmy stavby,...)",
+    "oe": "měrné jednotky (zapsané zkratkou)",
+    "om": "měny (zapsané zkratkou, symbolem)",
+    "op": "výrobky",
+    "or": "předpisy, normy,..., jejich sbírky",
+    "o_": "názvy nespecifikovaného typu / nezařaditelné do ostatních typů",
+    "p": "JMÉNA OSOB",
+    "pc": "obyvatelská jména",
+    "pd": "titul (pouze zkratkou)",
+    "pf": "křestní jméno",
+    "pm": "druhé křestní jméno",
+    "pp": "náboženské postavy, pohádkové a mytické postavy, personifikované vlastnosti",
+    "ps": "příjmení",
+    "p_": "jméno osoby nespecifikovaného typu / nezařaditelné do ostatních typů",
+    "t": "ČASOVÉ ÚDAJE",
+    "td": "den",
+    "tf": "svátky a významné dny",
+    "th": "hodina",
+    "tm": "měsíc",
+    "ty": "rok"
+}
 
-def generate_tei_header(mods_metadata: dict) -> Element:
+
+@timed("header")
+def generate_tei_header(mods_metadata: dict, config: dict = None) -> Element:
     """
     Generate a TEI header element from Kramerius+ object
 
@@ -47,11 +126,22 @@ def generate_tei_header(mods_metadata: dict) -> Element:
                 ...
             ]
         }
+    :param config: prepared configuration dictionary, NameTag interpretations filtered out by it are not generated
     :returns: an XML element with tag `teiHeader`
     """
     if "title" not in mods_metadata:
         abort(400, description="Attribute title is required.")
 
+    name_tag_properties_to_remove = frozenset(removed_name_tag_properties(config))
+    cache_key = header_cache_key(mods_metadata, name_tag_properties_to_remove)
+    cached_header = header_cache.get(cache_key)
+    if cached_header is not None:
+        tei_header = deepcopy(cached_header)
+        mods_metadata.setdefault("processedBy", []).append(processed_by_converter())
+        application = tei_header.findall("encodingDesc/appInfo/application")[-1]
+        application.set("when", mods_metadata["processedBy"][-1]["when"])
+        return tei_header
+
     tei_header_attrs = {}
     if "source" in mods_metadata:
         tei_header_attrs["corresp"] = mods_metadata["source"]
@@ -91,12 +181,7 @@ def generate_tei_header(mods_metadata: dict) -> Element:
         for idno_type in mods_metadata["identifiers"]:
             idno = SubElement(publication_stmt, "idno", {"type": "mods:" + idno_type["type"]})
             idno.text = idno_type["value"]
-    availability = SubElement(publication_stmt, "availability")
-    licence = SubElement(availability, "licence", {"resp": "#NameTag"})
-    licence.text = "CC BY-NC-SA"
-    availability = SubElement(publication_stmt, "availability")
-    licence = SubElement(availability, "licence", {"resp": "#UDPipe"})
-    licence.text = "CC BY-NC-SA"
+    publication_stmt.extend(deepcopy(availability) for availability in AVAILABILITIES)
 
     source_desc = SubElement(file_desc, "sourceDesc")
     SubElement(source_desc, "bibl")
@@ -104,12 +189,7 @@ def generate_tei_header(mods_metadata: dict) -> Element:
     # SubElement encodingDesc
     if "processedBy" not in mods_metadata:
         mods_metadata["processedBy"] = []
-    current_date = datetime.now()
-    mods_metadata["processedBy"].append({
-        "identifier": "TEIConverter",
-        "version": APP_VERSION,
-        "when": current_date.strftime('%Y-%m-%dT%H:%M:%S')
-    })
+    mods_metadata["processedBy"].append(processed_by_converter())
     encoding_desc = SubElement(tei_header, "encodingDesc")
     for app in mods_metadata["processedBy"]:
         app_info = SubElement(encoding_desc, "appInfo")
@@ -126,81 +206,82 @@ def generate_tei_header(mods_metadata: dict) -> Element:
             label.text = app["label"]
 
     # SubElement profileDesc
-    profile_desc = SubElement(tei_header, "profileDesc")
+    tei_header.append(deepcopy(generate_profile_desc(name_tag_properties_to_remove)))
+    if header_cache.max_size > 0:
+        header_cache.put(cache_key, deepcopy(tei_header))
+    return tei_header
+
+
+def processed_by_converter() -> dict:
+    """Entry of `processedBy` describing this conversion"""
+    return {
+        "identifier": "TEIConverter",
+        "version": APP_VERSION,
+        "when": datetime.now().strftime('%Y-%m-%dT%H:%M:%S')
+    }
+
+
+def header_cache_key(mods_metadata: dict, name_tag_properties_to_remove: frozenset) -> str:
+    """
+    Key of a header in the header cache
+
+    The key is computed before the `processedBy` entry of this conversion is added, so its `when` timestamp is not part
+    of it.
+    """
+    data = json.dumps([mods_metadata, sorted(name_tag_properties_to_remove)], sort_keys=True, default=str)
+    return sha256(data.encode("utf-8")).hexdigest()
+
+
+def generate_availabilities() -> Tuple[Element, ...]:
+    availabilities = []
+    for resp in ("#NameTag", "#UDPipe"):
+        availability = Element("availability")
+        licence = SubElement(availability, "licence", {"resp": resp})
+        licence.text = "CC BY-NC-SA"
+        availabilities.append(availability)
+    return tuple(availabilities)
+
+
+def generate_profile_desc(name_tag_properties_to_remove: frozenset) -> Element:
+    """
+    Profile description listing the NameTag interpretations which are not filtered out
+
+    The element is built once per set of removed categories and shared, callers must copy it before modifying it.
+    """
+    profile_desc = _profile_descs.get(name_tag_properties_to_remove)
+    if profile_desc is not None:
+        return profile_desc
+    profile_desc = Element("profileDesc")
     text_class = SubElement(profile_desc, "textClass")
     class_code = SubElement(text_class, "classCode", {"scheme": "https://ufal.mff.cuni.cz/nametag/2/models"})
     interp_grp = SubElement(class_code, "interpGrp")
-    interps = {
-        "a": "ČÍSLA JAKO SOUČÁSTI ADRES",
-        "ah": "číslo popisné",
-        "at": "telefon, fax",
-        "az": "PSČ",
-        "g": "GEOGRAFICKÉ NÁZVY",
-        "gc": "státní útvary",
-        "gh": "vodní útvary",
-        "gl": "přírodní oblasti / útvary",
-        "gq": "části obcí, pomístní názvy",
-        "gr": "menší územní jednotky",
-        "gs": "ulice, náměstí",
-        "gt": "kontinenty",
-        "gu": "obce, hrady a zámky",
-        "g_": "geografický název nespecifikovaného typu / nezařaditelný do ostatních typů",
-        "i": "NÁZVY INSTITUCÍ",
-        "ia": "přednášky, konference, soutěže,...",
-        "ic": "kulturní, vzdělávací a vědecké instituce, sportovní kluby,...",
-        "if": "firmy, koncerny, hotely,...",
-        "io": "státní a mezinárodní instituce, politické strany a hnutí, náboženské skupiny",
-        "i_": "instituce nespecifikovaného typu / nezařaditelné do ostatních typů",
-        "m": "NÁZVY MÉDIÍ",
-        "me": "e-mailové adresy",
-        "mi": "internetové odkazy",
-        "mn": "periodika, redakce, tiskové agentury",
-        "ms": "rozhlasové a televizní stanice",
-        "n": "ČÍSLA SE SPECIFICKÝM VÝZNAMEM",
-        "na": "věk",
-        "nc": "číslo s významem počtu",
-        "nb": "číslo strany, kapitoly, oddílu, obrázku",
-        "no": "číslo s významem pořadí",
-        "ns": "sportovní skóre",
-        "ni": "itemizátor",
-        "n_": "číslo se specifickým významem, jehož typ nebyl vyčleněn jako samostatný / nelze identifikovat",
-        "o": "NÁZVY VĚCÍ",
-        "oa": "kulturní artefakty (knihy, filmy stavby,...)",
-        "oe": "měrné jednotky (zapsané zkratkou)",
-        "om": "měny (zapsané zkratkou, symbolem)",
-        "op": "výrobky",
-        "or": "předpisy, normy,..., jejich sbírky",
-        "o_": "názvy nespecifikovaného typu / nezařaditelné do ostatních typů",
-        "p": "JMÉNA OSOB",
-        "pc": "obyvatelská jména",
-        "pd": "titul (pouze zkratkou)",
-        "pf": "křestní jméno",
-        "pm": "druhé křestní jméno",
-        "pp": "náboženské postavy, pohádkové a mytické postavy, personifikované vlastnosti",
-        "ps": "příjmení",
-        "p_": "jméno osoby nespecifikovaného typu / nezařaditelné do ostatních typů",
-        "t": "ČASOVÉ ÚDAJE",
-        "td": "den",
-        "tf": "svátky a významné dny",
-        "th": "hodina",
-        "tm": "měsíc",
-        "ty": "rok"
-    }
-    for interp in interps:
+    for interp in NAME_TAG_INTERPS:
+        if interp[0].lower() in name_tag_properties_to_remove:
+            continue
         interp_element = SubElement(interp_grp, "interp", {"xml:id": "nametag-" + interp})
-        interp_element.text = interps[interp]
+        interp_element.text = NAME_TAG_INTERPS[interp]
 
     lang_usage = SubElement(profile_desc, "langUsage")
     language = SubElement(lang_usage, "language", {"ident": "cze"})
     language.text = "cze"
-    return tei_header
+    _profile_descs[name_tag_properties_to_remove] = profile_desc
+    return profile_desc
 
 
-def generate_tei_page(page: dict) -> Element:
+# Licences of the linguistic annotations, copied into every header
+AVAILABILITIES = generate_availabilities()
+_profile_descs = {}
+header_cache = LRUCache(HEADER_CACHE_SIZE)
+
+
+@timed("convert")
+def generate_tei_page(page: dict, config: dict = None, facsimile: Element = None,
+                      word_ids: Iterator[int] = None, intern: InternTable = None) -> Element:
     """
     Generate a TEI page element from Kramerius+ object
 
-    :param page:
+    :param page: the tokens are a list of token objects, any iterable of them or `PageTokens`, as returned by
+        `json_stream.read_page`. Tokens which are not `PageTokens` are stored in `PageTokens` before the conversion
         {
             'id': str,
             'title': str,
@@ -226,6 +307,12 @@ def generate_tei_page(page: dict) -> Element:
                 ...
             ]
         }
+    :param config: prepared configuration dictionary, see `generate_tei_document`. If set, the filters are applied
+        while the page is generated and ALTO attributes are not added to the words
+    :param facsimile: element to which a surface with zones of the words is appended, requires `config`
+    :param word_ids: numbers of the `W-n` word ids of the zones, shared by all pages of a document
+    :param intern: strings, formatted numbers and word attributes shared by the pages of a conversion, the pages
+        converted with the same table share one object of every distinct attribute value
     :returns: an XML element with tag `div`
     """
     if "id" not in page:
@@ -233,47 +320,186 @@ def generate_tei_page(page: dict) -> Element:
     if "tokens" not in page:
         page["tokens"] = []
 
-    # Create page division with page break
+    # Create page division with page break, its other attributes are added after the tokens
     div = Element("div")
     pb_attrs = {"xml:id": str(page["id"]).replace(":", "-")}
+    pb = SubElement(div, "pb", pb_attrs)
+    p = SubElement(div, "p")
+
+    # Sentences are generated as their tokens end, the zones are numbered once the whole page is generated
+    zones = {} if facsimile is not None else None
+    for element in generate_tei_sentences(page, config, zones, intern):
+        p.append(element)
+
+    # Tokens read from a stream may be followed by the other attributes of the page
     if "title" in page:
-        pb_attrs["n"] = page["title"]
+        pb.set("n", page["title"])
     if "source" in page:
-        pb_attrs["corresp"] = page["source"]
-    SubElement(div, "pb", pb_attrs)
-    p = SubElement(div, "p")
+        pb.set("corresp", page["source"])
+
+    # Create a surface with zones, words are numbered before punctuation as in `process_tei_page`
+    if facsimile is not None:
+        surface = SubElement(facsimile, "surface", {"start": "#%s" % pb_attrs["xml:id"]})
+        for w in chain(div.iter("w"), div.iter("pc")):
+            zone_attrs = zones.pop(w, None)
+            if zone_attrs is not None:
+                current_word_id = "W-%d" % next(word_ids)
+                w.attrib["xml:id"] = current_word_id
+                SubElement(surface, "zone", {"start": "#"+current_word_id, **zone_attrs})
+    return div
+
+
+def generate_tei_sentences(page: dict, config: dict = None, zones: dict = None,
+                           intern: InternTable = None) -> Iterator[Element]:
+    """
+    Generate the content of the `p` element of a TEI page from Kramerius+ object one sentence at a time
+
+    A sentence is finished and yielded as soon as the first token of the next sentence is read, so the tokens can be
+    read from a stream and the sentences written to any sink. NameTag groups and dates are composed within the
+    sentence. The only page-level rewrite, a bibliography forming the only sentence of the page, is applied to the
+    last sentence, which is then followed by the `bibl` element.
+
+    :param page: page object, see `generate_tei_page`, its `tokens` are iterated once
+    :param config: prepared configuration dictionary, see `generate_tei_page`
+    :param zones: dictionary to which the zone attributes of the words are added, None if zones are not generated
+    :param intern: strings and attributes shared with the other pages of the conversion, see `generate_tei_page`
+    :returns: an iterator of the `s` elements and of the `bibl` element
+    """
+    # Filters
+    name_tag_properties_to_remove = removed_name_tag_properties(config)
+    udpipe_properties_to_remove = []
+    alto_config = []
+    if config is not None:
+        udpipe_properties_to_remove = [prop for prop in DEFAULT_CONFIG["UDPipe"] if prop not in config["UDPipe"]]
+        alto_config = [attr for attr in DEFAULT_CONFIG["ALTO"] if attr in config["ALTO"]]
+    # Lemmas of the current sentence removed by the filter, dates are composed from them
+    lemmas = {}
+
+    def get_lemma(word: Element) -> str:
+        return lemmas[word] if word in lemmas else word.attrib["lemma"]
+
+    def finish_sentence(sentence: Element):
+        for grp in sentence.findall(".//group[@ana='#nametag-P']"):
+            children = set(map(lambda e: e.tag, list(grp)))
+            children.discard("forename")
+            children.discard("placename")
+            children.discard("abbr")
+            children.discard("w")
+            children.discard("pc")
+            if len(children) == 0:
+                grp.tag = "persName"
+                grp.attrib.pop("type")
+        for grp in sentence.findall(".//date[@ana='#nametag-T']"):
+            td = grp.find("date[@ana='#nametag-td']")
+            tm = grp.find("date[@ana='#nametag-tm']")
+            ty = grp.find("date[@ana='#nametag-ty']")
+            if td is not None and tm is not None and ty is not None:
+                grp.tag = "date"
+                date_elements = ["", "", ""]
+                for sub in td.iter():
+                    if sub is not td:
+                        sub.set("ana", "#nametag-td")
+                        grp.append(sub)
+                        if sub.tag == "w":
+                            date_elements[2] = get_lemma(sub)
+                for sub in tm.iter():
+                    if sub is not tm:
+                        sub.set("ana", "#nametag-tm")
+                        grp.append(sub)
+                        if sub.tag == "w" and get_lemma(sub).lower() in calendar:
+                            date_elements[1] = calendar[get_lemma(sub)]
+                for sub in ty.iter():
+                    if sub is not ty:
+                        sub.set("ana", "#nametag-ty")
+                        grp.append(sub)
+                        if sub.tag == "w":
+                            date_elements[0] = get_lemma(sub)
+                grp.remove(td)
+                grp.remove(tm)
+                grp.remove(ty)
+                if len(date_elements[1]) == 1:
+                    date_elements[1] = "0" + date_elements[1]
+                if len(date_elements[2]) == 1:
+                    date_elements[2] = "0" + date_elements[2]
+                if len(date_elements[0]) == 4 and len(date_elements[1]) == 2 and len(date_elements[2]) == 2:
+                    grp.set("when", "-".join(date_elements))
+                if len(date_elements[0]) == 0 and len(date_elements[1]) == 2 and len(date_elements[2]) == 2:
+                    grp.set("when", "-%s-%s" % (date_elements[1], date_elements[2]))
+                if len(date_elements[0]) == 0 and len(date_elements[1]) == 0 and len(date_elements[2]) == 2:
+                    grp.set("when", "---%s" % (date_elements[0]))
+                if len(date_elements[0]) == 0 and len(date_elements[1]) == 2 and len(date_elements[2]) == 0:
+                    grp.set("when", "--%s" % (date_elements[1]))
+                if len(date_elements[0]) == 4 and len(date_elements[1]) == 2 and len(date_elements[2]) == 0:
+                    grp.set("when", "%s-%s" % (date_elements[0], date_elements[1]))
+                if len(date_elements[0]) == 4 and len(date_elements[1]) == 0 and len(date_elements[2]) == 0:
+                    grp.set("when", date_elements[0])
+        lemmas.clear()
 
     # Stack
     stack = []
 
     # Copy tokens
-    token_position_in_sentence = None
-    for token in page["tokens"]:
-        # Prepare token
-        if "content" not in token:
-            abort(400, description="Attribute `content` is required in all tokens.")
-        if "linguisticMetadata" not in token:
-            abort(400, description="Attribute `linguisticMetadata` is required in all tokens.")
-        if "position" not in token["linguisticMetadata"]:
-            abort(400, description="Attribute `position` is required in all tokens' linguistic metadata.")
-        check_properties = ["lemma", "uPosTag", "misc", "feats"]
-        for prop in check_properties:
-            if prop not in token["linguisticMetadata"]:
-                token["linguisticMetadata"][prop] = ""
+    shared = intern is not None
+    if not shared:
+        intern = InternTable()
+    if isinstance(page["tokens"], PageTokens):
+        tokens = page["tokens"]
+        if tokens.strings is not intern.strings:
+            # the prepared attributes are keyed by the codes of the strings of another table
+            intern = InternTable(tokens.strings, tokens.labels)
+            shared = False
+    else:
+        tokens = PageTokens.from_tokens(page["tokens"], intern)
+    strings = tokens.strings.values
+    # Attributes of the words by the codes of their POS, features and lemma
+    word_attributes = intern.attribute_cache(tuple(udpipe_properties_to_remove))
+    punct = tokens.strings.codes.get("PUNCT")
+    keep_n = "n" not in udpipe_properties_to_remove
+    remove_lemma = "lemma" in udpipe_properties_to_remove
+    # numbers repeat across the pages, formatting them once pays off only if the table is shared
+    format_number = intern.format_number if shared else str
+    format_position = intern.format_position if shared else str
+
+    def prepare_word(upos: str, not_space_after: bool, feats: str, lemma: str) -> Tuple[str, dict]:
+        """Tag and attributes of a word without `n` and ALTO attributes"""
+        tag = "w"
+        attrs = {"pos": upos}
+
+        # Check if it is a punctuation
+        if upos == "PUNCT":
+            tag = "pc"
+            attrs["join"] = "both" if not_space_after else "left"
+
+        # Add optional attributes
+        attrs["msd"] = feats
+        attrs["lemma"] = lemma
+        for prop in udpipe_properties_to_remove:
+            attrs.pop(prop, None)
+        return tag, attrs
 
+    labels = tokens.labels.values
+    label_codes = tokens.label_codes
+    alto_rows = tokens.alto_rows() if config is None or zones is not None else repeat(None)
+    s = None
+    sentences = 0
+    token_position_in_sentence = None
+    for index, (position, content, lemma, upos, feats, space_after_no, label_start, label_end, alto_row) in enumerate(
+            zip(tokens.position, tokens.content, tokens.lemma, tokens.upos, tokens.feats, tokens.space_after_no,
+                tokens.label_offsets, tokens.label_offsets[1:], alto_rows)):
         # Create paragraph for every sentence
-        linguistic_metadata = token["linguisticMetadata"]
-        if token_position_in_sentence is None or token_position_in_sentence > linguistic_metadata["position"]:
-            s = SubElement(p, "s")
+        if token_position_in_sentence is None or token_position_in_sentence > position:
+            # The previous sentence is complete
+            if s is not None:
+                finish_sentence(s)
+                yield s
+            s = Element("s")
+            sentences += 1
             stack = [s]  # Clear the stack
-        token_position_in_sentence = linguistic_metadata["position"]
+        token_position_in_sentence = position
 
         # Check nameTag info
-        name_tags = []
-        if "nameTagMetadata" in token:
-            name_tags = token["nameTagMetadata"].split("|")
-
-        if len(name_tags) > 0 or len(stack) > 1:
+        if label_end > label_start or len(stack) > 1:
+            name_tags = [labels[code] for code in label_codes[label_start:label_end]]
             # Count continued tags
             continued = 1
             for nameTag in name_tags:
@@ -285,206 +511,248 @@ def generate_tei_page(page: dict) -> Element:
             for nameTag in name_tags:
                 if "B-" in nameTag:
                     grp_name = nameTag[2:]
-                    if grp_name == "ah" or \
-                            grp_name == "na" or \
-                            grp_name == "nc" or \
-                            grp_name == "nb" or \
-                            grp_name == "ns" or \
-                            grp_name == "ni" or \
-                            grp_name == "n_":
-                        grp = SubElement(stack[-1], "num")
-                    elif grp_name == "at":
-                        grp = SubElement(stack[-1], "num", {"type": "phone"})
-                    elif grp_name == "az":
-                        grp = SubElement(stack[-1], "num", {"type": "zip"})
-                    elif grp_name == "c" or \
-                            grp_name == "C":
-                        grp = SubElement(stack[-1], "objectName", {"type": "bibliography"})
-                    elif grp_name == "gc":
-                        grp = SubElement(stack[-1], "placeName", {"ana": "#nametag-" + grp_name})
-                        grp = SubElement(grp, "country")
-                    elif grp_name == "gh":
-                        grp = SubElement(stack[-1], "geogName", {"type": "water"})
-                    elif grp_name == "gl":
-                        grp = SubElement(stack[-1], "geogName", {"type": "area"})
-                    elif grp_name == "gq" or grp_name == "gu":
-                        grp = SubElement(stack[-1], "placeName", {"ana": "#nametag-" + grp_name})
-                        grp = SubElement(grp, "settlement")
-                    elif grp_name == "gr":
-                        grp = SubElement(stack[-1], "placeName", {"ana": "#nametag-" + grp_name})
-                        grp = SubElement(grp, "region")
-                    elif grp_name == "gs":
-                        grp = SubElement(stack[-1], "address", {"ana": "#nametag-" + grp_name})
-                        grp = SubElement(grp, "street")
-                    elif grp_name == "A":
-                        grp = SubElement(stack[-1], "address")
-                    elif grp_name == "gt":
-                        grp = SubElement(stack[-1], "geogName", {"type": "continent"})
-                    elif grp_name == "g_":
-                        grp = SubElement(stack[-1], "placeName")
-                    elif grp_name == "ia" or \
-                            grp_name == "o_" or \
-                            grp_name == "p_":
-                        grp = SubElement(stack[-1], "objectName")
-                    elif grp_name == "ic" or \
-                            grp_name == "if" or \
-                            grp_name == "io" or \
-                            grp_name == "i_" or \
-                            grp_name == "mn" or \
-                            grp_name == "ms":
-                        grp = SubElement(stack[-1], "orgName")
-                    elif grp_name == "me":
-                        grp = SubElement(stack[-1], "email")
-                    elif grp_name == "mi":
-                        grp = SubElement(stack[-1], "ref", {"target": token["content"]})
-                    elif grp_name == "no":
-                        grp = SubElement(stack[-1], "num", {"type": "ordinal"})
-                    elif grp_name == "oa":
-                        grp = SubElement(stack[-1], "objectName", {"type": "artefact"})
-                    elif grp_name == "oe" or \
-                            grp_name == "om":
-                        grp = SubElement(stack[-1], "unit")
-                    elif grp_name == "op":
-                        grp = SubElement(stack[-1], "objectName", {"type": "product"})
-                    elif grp_name == "or":
-                        grp = SubElement(stack[-1], "objectName", {"type": "rule"})
-                    elif grp_name == "pc":
-                        grp = SubElement(stack[-1], "objectName", {"type": "population"})
-                    elif grp_name == "pd":
-                        grp = SubElement(stack[-1], "abbr")
-                    elif grp_name == "pf":
-                        grp = SubElement(stack[-1], "forename")
-                    elif grp_name == "pm":
-                        grp = SubElement(stack[-1], "forename", {"type": "middle"})
-                    elif grp_name == "pp" or \
-                            grp_name == "P":
-                        grp = SubElement(stack[-1], "persName")
-                    elif grp_name == "ps":
-                        grp = SubElement(stack[-1], "surname")
-                    elif grp_name == "t" or \
-                            grp_name == "T":
-                        grp = SubElement(stack[-1], "date")
-                    elif grp_name == "td":
-                        try:
-                            grp = SubElement(stack[-1], "date", {"when": "---%02d" % int(token["content"])})
-                        except ValueError:
-                            grp = SubElement(stack[-1], "date")
-                    elif grp_name == "tm":
-                        month = month_to_number(linguistic_metadata["lemma"])
-                        try:
-                            grp = SubElement(stack[-1], "date", {"when": "--%02d" % int(month)})
-                        except ValueError:
-                            grp = SubElement(stack[-1], "date")
-                    elif grp_name == "ty":
-                        grp = SubElement(stack[-1], "date", {"when": token["content"]})
-                    elif grp_name == "tf":
-                        grp = SubElement(stack[-1], "date", {"type": "holiday"})
-                    elif grp_name == "th":
-                        grp = SubElement(stack[-1], "time")
+                    if grp_name[:1].lower() in name_tag_properties_to_remove:
+                        # Keep the depth of the stack, words of the group are added to its parent
+                        stack.append(stack[-1])
+                        continue
+                    factory = NAME_TAG_FACTORIES.get(grp_name)
+                    if factory is not None:
+                        stack.append(factory(stack[-1], tokens.token(index)))
                     else:
-                        grp = SubElement(stack[-1], "group", {"type": grp_name})
-                    grp.set("ana", "#nametag-" + grp_name)
-                    stack.append(grp)
+                        stack.append(create_group(stack[-1], grp_name))
 
         # Add a token
-        tag = "w"
-        attrs = {
-            "n": str(linguistic_metadata["position"]),
-            "pos": linguistic_metadata["uPosTag"],
-        }
-
-        # Check if it is a punctuation
-        if linguistic_metadata["uPosTag"] == "PUNCT":
-            tag = "pc"
-            not_space_after = "SpaceAfter=No" in linguistic_metadata["misc"]
-            attrs["join"] = "both" if not_space_after else "left"
-
-        # Add optional attributes
-        if "feats" in linguistic_metadata:
-            attrs["msd"] = linguistic_metadata["feats"]
-        if "lemma" in linguistic_metadata:
-            attrs["lemma"] = linguistic_metadata["lemma"]
-        if "altoMetadata" in token:
-            for attr in ["height", "width", "vpos", "hpos"]:
-                if attr in token["altoMetadata"]:
-                    attrs["alto-"+attr] = str(token["altoMetadata"][attr])
+        key = (upos, upos == punct and space_after_no, feats, lemma)
+        prepared = word_attributes.get(key)
+        if prepared is None:
+            prepared = word_attributes[key] = prepare_word(strings[upos], key[1], strings[feats], strings[lemma])
+        tag, attrs = prepared
+        if keep_n:
+            attrs = {"n": format_position(position), **attrs}
+        zone_attrs = None
+        if config is None:
+            # nothing is filtered without a configuration, so `attrs` is a new dictionary with `n`
+            for name, value in zip(ALTO_NAMES, alto_row):
+                if value is not None:
+                    attrs[name] = format_number(value)
+        elif zones is not None:
+            zone_attrs = generate_zone_attributes(alto_row, alto_config, format_number)
 
         # Append to text
         w = SubElement(stack[-1], tag, attrs)
-        w.text = token["content"]
-
-    # postprocessing
-    for grp in div.findall(".//p"):
-        children = list(grp)
-        if len(children) == 1 and children[0].tag == "s":
-            children_of_s = list(children[0])
-            if len(children_of_s) == 1 and \
-                    children_of_s[0].tag == "objectName" and \
-                    children_of_s[0].get("type", "") == "bibliography":
-                children[0].remove(children_of_s[0])
-                children_of_s[0].tag = "bibl"
-                children_of_s[0].attrib.pop("type")
-                grp.append(children_of_s[0])
-        # TODO Check if parent is S and its parent is P and S contains only this element
-        # then remove S and move this element to P
-    for grp in div.findall(".//group[@ana='#nametag-P']"):
-        children = set(map(lambda e: e.tag, list(grp)))
-        children.discard("forename")
-        children.discard("placename")
-        children.discard("abbr")
-        children.discard("w")
-        children.discard("pc")
-        if len(children) == 0:
-            grp.tag = "persName"
-            grp.attrib.pop("type")
-    for grp in div.findall(".//date[@ana='#nametag-T']"):
-        td = grp.find("date[@ana='#nametag-td']")
-        tm = grp.find("date[@ana='#nametag-tm']")
-        ty = grp.find("date[@ana='#nametag-ty']")
-        if td is not None and tm is not None and ty is not None:
-            grp.tag = "date"
-            date_elements = ["", "", ""]
-            for sub in td.iter():
-                if sub is not td:
-                    sub.set("ana", "#nametag-td")
-                    grp.append(sub)
-                    if sub.tag == "w":
-                        date_elements[2] = sub.attrib["lemma"]
-            for sub in tm.iter():
-                if sub is not tm:
-                    sub.set("ana", "#nametag-tm")
-                    grp.append(sub)
-                    if sub.tag == "w" and sub.attrib["lemma"].lower() in calendar:
-                        date_elements[1] = calendar[sub.attrib["lemma"]]
-            for sub in ty.iter():
-                if sub is not ty:
-                    sub.set("ana", "#nametag-ty")
-                    grp.append(sub)
-                    if sub.tag == "w":
-                        date_elements[0] = sub.attrib["lemma"]
-            grp.remove(td)
-            grp.remove(tm)
-            grp.remove(ty)
-            if len(date_elements[1]) == 1:
-                date_elements[1] = "0" + date_elements[1]
-            if len(date_elements[2]) == 1:
-                date_elements[2] = "0" + date_elements[2]
-            if len(date_elements[0]) == 4 and len(date_elements[1]) == 2 and len(date_elements[2]) == 2:
-                grp.set("when", "-".join(date_elements))
-            if len(date_elements[0]) == 0 and len(date_elements[1]) == 2 and len(date_elements[2]) == 2:
-                grp.set("when", "-%s-%s" % (date_elements[1], date_elements[2]))
-            if len(date_elements[0]) == 0 and len(date_elements[1]) == 0 and len(date_elements[2]) == 2:
-                grp.set("when", "---%s" % (date_elements[0]))
-            if len(date_elements[0]) == 0 and len(date_elements[1]) == 2 and len(date_elements[2]) == 0:
-                grp.set("when", "--%s" % (date_elements[1]))
-            if len(date_elements[0]) == 4 and len(date_elements[1]) == 2 and len(date_elements[2]) == 0:
-                grp.set("when", "%s-%s" % (date_elements[0], date_elements[1]))
-            if len(date_elements[0]) == 4 and len(date_elements[1]) == 0 and len(date_elements[2]) == 0:
-                grp.set("when", date_elements[0])
+        w.text = strings[content]
+        if remove_lemma:
+            lemmas[w] = strings[lemma]
+        if zone_attrs is not None:
+            zones[w] = zone_attrs
+
+    record_pages("convert", 1, len(tokens))
+    if s is None:
+        return
+    finish_sentence(s)
+
+    # A bibliography forming the only sentence of the page is moved out of the sentence
+    bibl = None
+    if sentences == 1:
+        children_of_s = list(s)
+        if len(children_of_s) == 1 and \
+                children_of_s[0].tag == "objectName" and \
+                children_of_s[0].get("type", "") == "bibliography":
+            bibl = children_of_s[0]
+            s.remove(bibl)
+            bibl.tag = "bibl"
+            bibl.attrib.pop("type")
+    yield s
+    if bibl is not None:
+        yield bibl
+
+
+def generate_zone_attributes(alto_row: tuple, alto_config: List[str],
+                             format_number: Callable[[Any], str] = str) -> Optional[dict]:
+    """
+    Generate attributes of a facsimile zone from ALTO metadata of a token
+
+    :param alto_row: ALTO values of a token, see `PageTokens.alto_rows`
+    :param alto_config: ALTO attributes kept by the configuration
+    :param format_number: formatting of the values, see `InternTable.format_number`
+    :returns: attributes of the zone without `start`, None if the token has none of the kept attributes
+    """
+    height, width, vpos, hpos = alto_row
+    alto_metadata = {"height": height, "width": width, "vpos": vpos, "hpos": hpos}
+    if not any(alto_metadata[attr] is not None for attr in alto_config):
+        return None
+    zone_attrs = {}
+    if "hpos" in alto_config and hpos is not None:
+        zone_attrs["ulx"] = format_number(hpos)
+    if "vpos" in alto_config and vpos is not None:
+        zone_attrs["uly"] = format_number(vpos)
+    if "width" in alto_config and width is not None and hpos is not None:
+        zone_attrs["lrx"] = format_number(float(hpos) + float(width))
+    if "height" in alto_config and height is not None and vpos is not None:
+        zone_attrs["lry"] = format_number(float(vpos) + float(height))
+    return zone_attrs
+
+
+def convert_tei_page(page: dict, intern: InternTable = None) -> Element:
+    """
+    Generate a TEI page element from Kramerius+ object, see `generate_tei_page`, or return it from the page cache
+
+    The element may be shared with the cache and must not be modified.
+    """
+    key, cached = get_cached_page(page)
+    if cached is not None:
+        return cached
+    div = generate_tei_page(page, intern=intern)
+    put_cached_page(key, div)
     return div
 
 
-def generate_tei_document(header: FileStorage, pages: List[FileStorage], config: dict = None) -> Element:
+def generate_tei_pages(pages: Iterable[dict]) -> Iterator[Tuple[str, Union[Element, HTTPException]]]:
+    """
+    Generate TEI page elements from a sequence of Kramerius+ objects
+
+    A page which can not be converted does not stop the conversion of the following pages, the error is returned
+    in place of its element.
+
+    :param pages: iterable of page objects, see `generate_tei_page`, or exceptions raised while reading them
+    :returns: an iterator of tuples (id of the page, XML element with tag `div` or the HTTP error)
+    """
+    intern = InternTable()
+    for page in pages:
+        page_id = page.get("id") if isinstance(page, dict) else None
+        if intern.is_full():
+            intern = InternTable()
+        try:
+            if isinstance(page, HTTPException):
+                raise page
+            if not isinstance(page, dict):
+                abort(400, description="Page must be a JSON object.")
+            yield page_id, convert_tei_page(page, intern)
+        except HTTPException as e:
+            yield page_id, e
+        except (TypeError, ValueError, KeyError, AttributeError) as e:
+            yield page_id, BadRequest(description="Invalid page: %s" % e)
+
+
+DEFAULT_CONFIG = {
+    "NameTag": ["a", "g", "i", "m", "n", "o", "p", "t"],
+    "UDPipe": ["n", "lemma", "pos", "msd", "join"],
+    "ALTO": ["width", "height", "vpos", "hpos"]
+}
+DEFAULT_ALTO_CONFIG = ["alto-" + x for x in DEFAULT_CONFIG["ALTO"]]
+
+
+def prepare_config(config: dict = None) -> dict:
+    """
+    Fill the missing filter categories of a merge configuration with default values
+
+    :param config: configuration dictionary, see `generate_tei_document`
+    :returns: a new configuration dictionary with all categories filled in
+    """
+    config = dict(config or {})
+    for category in DEFAULT_CONFIG:
+        if category not in config or config[category] is None:
+            config[category] = DEFAULT_CONFIG[category]
+    return config
+
+
+def removed_name_tag_properties(config: dict = None) -> List[str]:
+    """NameTag categories filtered out by a prepared configuration, none if there is no configuration"""
+    if config is None:
+        return []
+    return list(set(DEFAULT_CONFIG["NameTag"]) - set(config["NameTag"]))
+
+
+def uses_alto(config: dict) -> bool:
+    alto_config = ["alto-" + x for x in config["ALTO"]]
+    return len(list(set(DEFAULT_ALTO_CONFIG) & set(alto_config))) > 0
+
+
+@timed("header")
+def prepare_tei_header(header: FileStorage, config: dict) -> (dict, Element):
+    """
+    Parse a TEI header and remove the NameTag interpretations filtered out by the configuration
+
+    :param header: FileStorage of header
+    :param config: prepared configuration dictionary
+    :returns: attributes of the `TEI` element and the `teiHeader` element
+    """
+    name_tag_properties_to_remove = removed_name_tag_properties(config)
+
+    tei_header = parse(header.stream).getroot()
+    tei_attrs = move_tei_header_attributes(tei_header)
+
+    # Remove unused NameTag elements
+    for interp_group in tei_header.findall(".//interpGrp"):
+        for sub in list(interp_group):
+            for attr in sub.attrib:
+                if attr[-2:] == "id" and sub.attrib[attr].lower()[8] in name_tag_properties_to_remove:
+                    interp_group.remove(sub)
+        if len(interp_group) == 0 and interp_group.text is not None and not interp_group.text.strip():
+            # the indentation of the removed interpretations, a group without them is written as an empty element
+            interp_group.text = None
+    return tei_attrs, tei_header
+
+
+def parse_page(stream: BinaryIO) -> Element:
+    """Parse a TEI page uploaded as XML or in the binary format of `binary.encode_element`"""
+    start = stream.read(len(BINARY_MAGIC))
+    if is_binary(start):
+        return decode_element(start + stream.read())
+    try:
+        stream.seek(-len(start), SEEK_CUR)
+    except (AttributeError, OSError):
+        return parse(BytesIO(start + stream.read())).getroot()
+    return parse(stream).getroot()
+
+
+def move_tei_header_attributes(tei_header: Element) -> dict:
+    """Remove the attributes of a `teiHeader` element and return them as attributes of the `TEI` element"""
+    tei_attrs = {"xmlns": "http://www.tei-c.org/ns/1.0"}
+    for attr in tei_header.attrib:
+        tei_attrs[attr] = tei_header.attrib.get(attr)
+    tei_header.attrib.clear()
+    return tei_attrs
+
+
+def process_tei_page(page_element: Element, config: dict, facsimile: Element = None, word_id: int = 1,
+                     words: List[Element] = None) -> int:
+    """
+    Apply the configured filters to a parsed TEI page and move its ALTO attributes to a new facsimile surface
+
+    :param page_element: parsed TEI page, modified in place
+    :param config: prepared configuration dictionary
+    :param facsimile: element to which the surface of the page is appended, None if ALTO is not used
+    :param word_id: first free number of the `W-n` word ids
+    :param words: list to which the words are appended in the order of their ids
+    :returns: the next free number of the `W-n` word ids
+    """
+    with stage("filter"):
+        page_filter = compile_page_filter(config)
+        pb, zoned_words, zoned_punctuation, tokens = page_filter.apply(page_element, facsimile is not None)
+    record_pages("merge", 1, tokens)
+
+    # Create a surface and transform alto attributes to zones in it, words are numbered before punctuation
+    if facsimile is not None:
+        surface_attrs = {}
+        if pb is not None:
+            for attr in pb.attrib:
+                if attr[-2:] == "id":
+                    surface_attrs["start"] = "#%s" % pb.attrib[attr]
+        surface = SubElement(facsimile, "surface", surface_attrs)
+        for word, zone_attrs in chain(zoned_words, zoned_punctuation):
+            current_word_id = "W-" + str(word_id)
+            word.attrib["xml:id"] = current_word_id
+            zone = SubElement(surface, "zone", {"start": "#" + current_word_id})
+            zone.attrib.update(zone_attrs)
+            if words is not None:
+                words.append(word)
+            word_id += 1
+    return word_id
+
+
+def generate_tei_document(header: FileStorage, pages: List[FileStorage], config: dict = None,
+                          workers: int = 1) -> Element:
     """
     Generate a TEI document from header and pages
 
@@ -496,50 +764,207 @@ def generate_tei_document(header: FileStorage, pages: List[FileStorage], config:
             'UDPipe': str[],    # Default ["n", "lemma", "pos", "msd", "join"]
             'ALTO': str[]       # Default ["width", "height", "vpos", "hpos"]
         }
+    :param workers: number of processes parsing and filtering the pages, the pages are processed in this process
+        if it is 1. The document is the same for any number of workers.
     :returns: an XML document
     """
-    # Prepare config with default values
-    default_config = {
-        "NameTag": ["a", "g", "i", "m", "n", "o", "p", "t"],
-        "UDPipe": ["n", "lemma", "pos", "msd", "join"],
-        "ALTO": ["width", "height", "vpos", "hpos"]
-    }
-    if config is None:
-        config = {}
+    config = prepare_config(config)
 
-    # If a category of filter is not in config, fill it in
-    for category in default_config:
-        if category not in config or config[category] is None:
-            config[category] = default_config[category]
+    # Create top XML document with teiHeader
+    tei_attrs, tei_header = prepare_tei_header(header, config)
+    tei = Element("TEI", tei_attrs)
+    tei.append(tei_header)
 
-    # Create top XML document
-    tei = Element("TEI", {"xmlns": "http://www.tei-c.org/ns/1.0"})
+    # Create facsimile
+    facsimile = None
+    if uses_alto(config):
+        facsimile = SubElement(tei, "facsimile")
 
-    # NameTag properties that have to be deleted
-    name_tag_properties_to_remove = list(set(default_config["NameTag"]) - set(config["NameTag"]))
+    # Create text
+    text = SubElement(tei, "text")
+    body = SubElement(text, "body")
 
-    # Create teiHeader
-    tei_header = parse(header.stream).getroot()
-    tei.append(tei_header)
-    for attr in tei_header.attrib:
-        tei.set(attr, tei_header.attrib.get(attr))
-    tei_header.attrib.clear()
+    # Create pages
+    if workers > 1 and len(pages) > 1:
+        pool = get_page_pool(workers)
+        with stage("parallel"):
+            results = list(pool.map(process_tei_page_data, [page.stream.read() for page in pages], repeat(config)))
+        word_id = 1
+        for page_element, surface, words in results:
+            # metrics recorded by the workers are lost, the tokens are counted again only if they are collected
+            if METRICS_ENABLED:
+                record_pages("merge", 1, sum(1 for _ in chain(page_element.iter("w"), page_element.iter("pc"))))
+            if surface is not None:
+                # Pages are numbered from 1 by the workers, shift the ids after the previous pages
+                for word, zone in zip(words, surface):
+                    current_word_id = "W-" + str(word_id)
+                    word.attrib["xml:id"] = current_word_id
+                    zone.attrib["start"] = "#" + current_word_id
+                    word_id += 1
+                facsimile.append(surface)
+            body.append(page_element)
+        return tei
 
-    # Remove unused NameTag elements
-    for interp_group in tei_header.findall(".//interpGrp"):
-        for sub in list(interp_group):
-            for attr in sub.attrib:
-                if attr[-2:] == "id" and sub.attrib[attr].lower()[8] in name_tag_properties_to_remove:
-                    interp_group.remove(sub)
+    word_id = 1
+    for page in pages:
+        with stage("parse"):
+            page_element = parse_page(page.stream)
+        word_id = process_tei_page(page_element, config, facsimile, word_id)
+        body.append(page_element)
+    return tei
 
-    # Prepare ALTO prefixes
-    default_alto_config = ["alto-" + x for x in default_config["ALTO"]]
-    alto_config = ["alto-" + x for x in config["ALTO"]]
-    use_alto = len(list(set(default_alto_config) & set(alto_config))) > 0
+
+def stream_tei_page(stream: BinaryIO, config: dict, writer: XMLStreamWriter, surface_writer: XMLStreamWriter = None,
+                    word_id: int = 1) -> int:
+    """
+    Filter a TEI page and write it and its facsimile surface without parsing the whole page into memory
+
+    The output is the same as writing the page and the surface after `process_tei_page`. The words are numbered before
+    the punctuation, so a page in XML is read twice, first to count its words with zones and then to filter and write
+    it. A page in the binary format is processed as a whole.
+
+    :param stream: seekable stream of the TEI page in XML or in the binary format
+    :param config: prepared configuration dictionary
+    :param writer: writer of the page
+    :param surface_writer: writer of the surface of the page, None if ALTO is not used
+    :param word_id: first free number of the `W-n` word ids
+    :returns: the next free number of the `W-n` word ids
+    """
+    start = stream.read(len(BINARY_MAGIC))
+    if is_binary(start):
+        with stage("parse"):
+            page_element = decode_element(start + stream.read())
+        facsimile = Element("facsimile") if surface_writer is not None else None
+        word_id = process_tei_page(page_element, config, facsimile, word_id)
+        writer.element(page_element)
+        if facsimile is not None:
+            for surface in facsimile:
+                surface_writer.element(surface)
+        return word_id
+    stream.seek(-len(start), SEEK_CUR)
+
+    page_filter = compile_page_filter(config)
+    if surface_writer is None:
+        with stage("filter"):
+            tokens = page_filter.write(stream, writer)
+        record_pages("merge", 1, tokens)
+        return word_id
+
+    origin = stream.tell()
+    with stage("parse"):
+        surface_attrs, zoned_words = page_filter.scan(stream)
+    stream.seek(origin)
+    word_ids = count(word_id)
+    punctuation_ids = count(word_id + zoned_words)
+    surface_writer.start("surface", surface_attrs)
+    with SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE) as punctuation:
+        punctuation_writer = XMLStreamWriter(punctuation, surface_writer.serializer.pretty,
+                                             surface_writer.depth + len(surface_writer.stack))
+        with stage("filter"):
+            tokens = page_filter.write(stream, writer, (surface_writer, punctuation_writer), word_ids,
+                                       punctuation_ids)
+        if punctuation.tell() > 0:
+            surface_writer.flush()
+            punctuation.seek(0)
+            copyfileobj(punctuation, surface_writer.out)
+    surface_writer.end()
+    record_pages("merge", 1, tokens)
+    return next(punctuation_ids)
+
+
+def stream_tei_pages(pages: Iterable[FileStorage], config: dict, writer: XMLStreamWriter, output: BytesIO,
+                     body_writer: XMLStreamWriter, word_id: int = 1) -> Iterator[bytes]:
+    """
+    Write pages with `stream_tei_page` and their surfaces after the last element opened by `writer`
+
+    Each page is closed once it has been written. The surface of a page is spooled, the output of `writer` and the
+    surface are yielded after every page.
+
+    :param pages: FileStorage of the pages with seekable streams
+    :param config: prepared configuration dictionary
+    :param writer: writer of the facsimile, writing to `output`
+    :param output: output of `writer`
+    :param body_writer: writer of the pages
+    :param word_id: first free number of the `W-n` word ids
+    :returns: an iterator of UTF-8 encoded parts of the facsimile, its return value is the next free word id
+    """
+    use_alto = uses_alto(config)
+    for page in pages:
+        with SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE) as surface:
+            surface_writer = None
+            if use_alto:
+                surface_writer = XMLStreamWriter(surface, writer.serializer.pretty, writer.depth + len(writer.stack))
+            word_id = stream_tei_page(page.stream, config, body_writer, surface_writer, word_id)
+            page.close()
+            if surface.tell() > 0:
+                writer.flush()
+                yield drain(output)
+                surface.seek(0)
+                yield from iter(lambda: surface.read(CHUNK_SIZE), b"")
+    return word_id
+
+
+def process_tei_page_data(data: bytes, config: dict) -> Tuple[Element, Optional[Element], List[Element]]:
+    """
+    Parse and process a TEI page in a worker process, see `process_tei_page`
+
+    :param data: the TEI page
+    :param config: prepared configuration dictionary
+    :returns: the page, its surface (None if ALTO is not used) and its words in the order of their ids,
+        the ids are numbered from 1
+    """
+    page_element = parse_page(BytesIO(data))
+    facsimile = Element("facsimile") if uses_alto(config) else None
+    words = []
+    process_tei_page(page_element, config, facsimile, 1, words)
+    surface = facsimile[0] if facsimile is not None else None
+    return page_element, surface, words
+
+
+_page_pool = None
+_page_pool_workers = 0
+_page_pool_lock = Lock()
+
+
+def get_page_pool(workers: int) -> ProcessPoolExecutor:
+    """Return the process pool of this process for parallel page processing, created on first use"""
+    global _page_pool, _page_pool_workers
+    with _page_pool_lock:
+        if _page_pool is None or _page_pool_workers != workers:
+            if _page_pool is not None:
+                _page_pool.shutdown(wait=False)
+            # the workers of the server run threads, forking them could copy a lock held by another thread
+            _page_pool = ProcessPoolExecutor(max_workers=workers, mp_context=get_context("spawn"))
+            _page_pool_workers = workers
+        return _page_pool
+
+
+def generate_tei_document_from_json(header: dict, pages: Iterable[dict], config: dict = None,
+                                    intern: InternTable = None) -> Element:
+    """
+    Generate a TEI document directly from Kramerius+ objects of the header and pages
+
+    The result is the same as merging the converted header and pages with `generate_tei_document`, but the filters
+    are applied while the elements are generated and nothing is serialized and parsed again.
+
+    :param header: header object, see `generate_tei_header`
+    :param pages: iterable of page objects, see `generate_tei_page`
+    :param config: configuration dictionary, see `generate_tei_document`
+    :param intern: strings shared by the pages, see `generate_tei_page`, a new table if not given
+    :returns: an XML document
+    """
+    config = prepare_config(config)
+    if intern is None:
+        intern = InternTable()
+
+    # Create top XML document with teiHeader
+    tei_header = generate_tei_header(header, config)
+    tei = Element("TEI", move_tei_header_attributes(tei_header))
+    tei.append(tei_header)
 
     # Create facsimile
     facsimile = None
-    if use_alto:
+    if uses_alto(config):
         facsimile = SubElement(tei, "facsimile")
 
     # Create text
@@ -547,67 +972,398 @@ def generate_tei_document(header: FileStorage, pages: List[FileStorage], config:
     body = SubElement(text, "body")
 
     # Create pages
-    word_id = 1
+    word_ids = count(1)
     for page in pages:
-        page_element = parse(page.stream).getroot()
-
-        # Create a surface
-        surface = None
-        if use_alto and facsimile is not None:
-            surface_attrs = {}
-            pb = page_element.findall(".//pb")
-            if pb:
-                pb = pb.pop()
-                for attr in pb.attrib:
+        if not isinstance(page, dict):
+            abort(400, description="Page must be a JSON object.")
+        body.append(generate_tei_page(page, config, facsimile, word_ids, intern))
+    return tei
+
+
+def stream_tei_document(header: FileStorage, pages: List[FileStorage], config: dict = None,
+                        pretty: bool = True) -> Iterator[bytes]:
+    """
+    Generate a TEI document from header and pages as a stream of encoded chunks
+
+    Pages are parsed and released one at a time, each page is closed once it has been processed. The `facsimile`
+    is written to the output as the pages are processed, while their `div` elements are spooled to a temporary file
+    and copied to the `body` at the end. The header is parsed before the first chunk is produced, so errors in it
+    are raised by this call.
+
+    :param header: FileStorage of header
+    :param pages: list of FileStorage
+    :param config: configuration dictionary, see `generate_tei_document`
+    :param pretty: indent the document, the output is the same as `serialize` of `generate_tei_document`
+    :returns: an iterator of UTF-8 encoded parts of the XML document
+    """
+    config = prepare_config(config)
+    tei_attrs, tei_header = prepare_tei_header(header, config)
+
+    def generate():
+        output = BytesIO()
+        writer = XMLStreamWriter(output, pretty)
+        writer.declaration()
+        writer.start("TEI", tei_attrs)
+        writer.element(tei_header)
+        yield drain(output)
+
+        with SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE) as spool:
+            body_writer = XMLStreamWriter(spool, pretty, depth=3)
+            use_alto = uses_alto(config)
+            if use_alto:
+                writer.start("facsimile")
+            yield from stream_tei_pages(pages, config, writer, output, body_writer)
+            if use_alto:
+                writer.end()
+
+            writer.start("text")
+            writer.start("body")
+            if spool.tell() > 0:
+                writer.flush()
+                yield drain(output)
+                spool.seek(0)
+                for chunk in iter(lambda: spool.read(CHUNK_SIZE), b""):
+                    yield chunk
+        writer.end()
+        writer.end()
+        writer.end()
+        yield drain(output)
+
+    return generate()
+
+
+def append_tei_document(document: BinaryIO, pages: List[FileStorage], config: dict = None) -> Iterator[bytes]:
+    """
+    Append pages to a TEI document generated by the merge as a stream of encoded chunks
+
+    The document is not parsed, only the ends of its `facsimile` and `body` elements and the last `W-n` word id are
+    located in it. The new surfaces and pages are inserted there with the indentation of the document, the existing
+    parts are copied unchanged. The result is the same as merging all the pages at once with the same filters.
+    The document is located before the first chunk is produced, so errors in it are raised by this call.
+
+    :param document: seekable binary stream of the TEI document, it is read until the iterator is exhausted
+    :param pages: list of FileStorage of the new pages
+    :param config: configuration dictionary, see `generate_tei_document`
+    :returns: an iterator of UTF-8 encoded parts of the XML document
+    """
+    config = prepare_config(config)
+    facsimile_end, body_end, word_id, pretty = locate_tei_document_tail(document)
+    if uses_alto(config) and facsimile_end is None:
+        raise BadRequest(description="The document has no `facsimile`, the ALTO attributes of the new pages can not "
+                                     "be appended. Remove them with the `ALTO` filter.")
+    if facsimile_end is None:
+        facsimile_end = body_end
+
+    def generate():
+        output = BytesIO()
+        writer = XMLStreamWriter(output, pretty, depth=2)
+        yield from copy_range(document, 0, facsimile_end)
+
+        with SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE) as spool:
+            body_writer = XMLStreamWriter(spool, pretty, depth=3)
+            yield from stream_tei_pages(pages, config, writer, output, body_writer, word_id)
+
+            yield from copy_range(document, facsimile_end, body_end)
+            spool.seek(0)
+            for chunk in iter(lambda: spool.read(CHUNK_SIZE), b""):
+                yield chunk
+        document.seek(body_end)
+        for chunk in iter(lambda: document.read(CHUNK_SIZE), b""):
+            yield chunk
+
+    return generate()
+
+
+def locate_tei_document_tail(document: BinaryIO) -> Tuple[Optional[int], int, int, bool]:
+    """
+    Find the places where pages are appended to a TEI document without parsing it
+
+    The `facsimile` is searched from the start, as it precedes the pages, the `body` from the end.
+
+    :param document: seekable binary stream of the TEI document
+    :returns: offsets of the whitespace before the end tags of `facsimile` (None if there is no facsimile) and
+        `body`, the next free number of the `W-n` word ids and whether the document is indented
+    """
+    document.seek(0)
+    if b"<TEI" not in document.read(CHUNK_SIZE):
+        raise BadRequest(description="The document is not a TEI document generated by the merge.")
+    document.seek(0, SEEK_END)
+    body_end = rfind_bytes(document, b"</body>", document.tell())
+    if body_end < 0:
+        raise BadRequest(description="The document has no `body` element with pages.")
+    body_start = rfind_bytes(document, b"<body>", body_end)
+    facsimile_end = find_bytes(document, b"</facsimile>", 0, body_start)
+
+    word_id = 1
+    if facsimile_end >= 0:
+        last_zone = rfind_bytes(document, b'"#W-', facsimile_end)
+        if last_zone >= 0:
+            document.seek(last_zone + 4)
+            number = document.read(24).split(b'"', 1)
+            if len(number) < 2 or not number[0].isdigit():
+                raise BadRequest(description="The last word id of the `facsimile`, `W-%s`, is not a `W-n` id of the "
+                                             "merge." % number[0].decode("utf-8", "replace"))
+            word_id = int(number[0]) + 1
+    pretty = skip_whitespace_back(document, body_end) < body_end
+    if facsimile_end < 0:
+        return None, skip_whitespace_back(document, body_end), word_id, pretty
+    return skip_whitespace_back(document, facsimile_end), skip_whitespace_back(document, body_end), word_id, pretty
+
+
+def find_bytes(stream: BinaryIO, pattern: bytes, start: int = 0, end: int = None) -> int:
+    """Offset of the first occurrence of `pattern` between `start` and `end` of a seekable stream, -1 if not found"""
+    stream.seek(start)
+    position = start
+    overlap = b""
+    while end is None or position < end:
+        size = CHUNK_SIZE if end is None else min(CHUNK_SIZE, end - position)
+        chunk = stream.read(size)
+        if not chunk:
+            break
+        data = overlap + chunk
+        index = data.find(pattern)
+        if index >= 0:
+            return position - len(overlap) + index
+        overlap = data[len(data) - len(pattern) + 1:]
+        position += len(chunk)
+    return -1
+
+
+def rfind_bytes(stream: BinaryIO, pattern: bytes, end: int) -> int:
+    """Offset of the last occurrence of `pattern` before `end` of a seekable stream, -1 if not found"""
+    position = end
+    overlap = b""
+    while position > 0:
+        size = min(CHUNK_SIZE, position)
+        position -= size
+        stream.seek(position)
+        data = stream.read(size) + overlap
+        index = data.rfind(pattern)
+        if index >= 0:
+            return position + index
+        overlap = data[:len(pattern) - 1]
+    return -1
+
+
+def skip_whitespace_back(stream: BinaryIO, end: int) -> int:
+    """Offset of the whitespace preceding `end` of a seekable stream, `end` if there is none"""
+    start = max(0, end - 256)
+    stream.seek(start)
+    data = stream.read(end - start)
+    return end - (len(data) - len(data.rstrip()))
+
+
+def copy_range(stream: BinaryIO, start: int, end: int) -> Iterator[bytes]:
+    """Read a part of a seekable stream in chunks"""
+    position = start
+    while position < end:
+        stream.seek(position)
+        chunk = stream.read(min(CHUNK_SIZE, end - position))
+        if not chunk:
+            break
+        position += len(chunk)
+        yield chunk
+
+
+class PageFilter:
+    """
+    Filters of a merge configuration compiled for a single walk over a parsed TEI page
+
+    The walk unwraps the filtered NameTag elements, removes the filtered UDPipe attributes and all ALTO attributes
+    of words and collects the zone attributes of the kept ALTO attributes.
+    """
+
+    def __init__(self, config: dict):
+        self.name_tag_properties_to_remove = frozenset(removed_name_tag_properties(config))
+        alto_config = ["alto-" + x for x in config["ALTO"]]
+        self.zone_attributes = tuple(attr for attr in DEFAULT_ALTO_CONFIG if attr in alto_config)
+        self.removed_attributes = tuple(DEFAULT_ALTO_CONFIG) + \
+            tuple(prop for prop in DEFAULT_CONFIG["UDPipe"] if prop not in config["UDPipe"])
+        self.ulx = "alto-hpos" in alto_config
+        self.uly = "alto-vpos" in alto_config
+        self.lrx = "alto-width" in alto_config
+        self.lry = "alto-height" in alto_config
+
+    def apply(self, page_element: Element, zones: bool = True) -> (Optional[Element], List[tuple], List[tuple], int):
+        """
+        Filter a page in place
+
+        :param page_element: parsed TEI page
+        :param zones: whether zone attributes are collected
+        :returns: the last `pb` element of the page, lists of tuples (element, zone attributes) of the words and
+            of the punctuation with kept ALTO attributes, in document order, and the number of words and punctuation
+        """
+        state = [None, [], [], 0] if zones else [None, None, None, 0]
+        self._walk(page_element, state)
+        return state[0], state[1], state[2], state[3]
+
+    def _walk(self, element: Element, state: list):
+        children = None
+        for i, sub in enumerate(element):
+            tag = sub.tag
+            if tag == "w" or tag == "pc":
+                self._filter_word(sub, state[1] if tag == "w" else state[2])
+                state[3] += 1
+            elif tag == "pb":
+                state[0] = sub
+            if len(sub):
+                self._walk(sub, state)
+            ana = sub.get("ana")
+            if ana is not None and ana[:9].lower() == "#nametag-" and \
+                    ana[9:10].lower() in self.name_tag_properties_to_remove:
+                if tag == "w" or tag == "pc":
+                    # Words of composed dates are kept, only their category is removed
+                    del sub.attrib["ana"]
+                else:
+                    if children is None:
+                        children = element[:i]
+                    children.extend(sub)
+                    continue
+            if children is not None:
+                children.append(sub)
+        if children is not None:
+            element[:] = children
+
+    def scan(self, stream: BinaryIO) -> (dict, int):
+        """
+        Read a TEI page without keeping its elements
+
+        :param stream: the TEI page
+        :returns: attributes of the surface of the page and the number of words with kept ALTO attributes
+        """
+        surface_attrs = {}
+        zoned_words = 0
+        parents = []
+        for event, elem in iterparse(stream, ("start", "end")):
+            if event == "start":
+                parents.append(elem)
+                continue
+            parents.pop()
+            if elem.tag == "pb":
+                surface_attrs = {}
+                for attr in elem.attrib:
                     if attr[-2:] == "id":
-                        surface_attrs["start"] = "#%s" % pb.attrib[attr]
-            surface = SubElement(facsimile, "surface", surface_attrs)
-
-        # Find all words
-        for word in page_element.findall(".//w") + page_element.findall(".//pc"):
-            # Transform alto attributes to zones in the surface
-            if use_alto and surface is not None:
-                alto_attrs_in_word = list(set(word.attrib) & set(default_alto_config) & set(alto_config))
-                if len(alto_attrs_in_word) > 0:
-                    current_word_id = "W-"+str(word_id)
-                    word.attrib["xml:id"] = current_word_id
-                    zone = SubElement(surface, "zone", {"start": "#"+current_word_id})
-                    if "alto-hpos" in alto_attrs_in_word:
-                        zone.attrib["ulx"] = word.attrib["alto-hpos"]
-                    if "alto-vpos" in alto_attrs_in_word:
-                        zone.attrib["uly"] = word.attrib["alto-vpos"]
-                    if "alto-width" in alto_attrs_in_word and "alto-hpos" in word.attrib:
-                        zone.attrib["lrx"] = str(float(word.attrib["alto-hpos"]) + float(word.attrib["alto-width"]))
-                    if "alto-height" in alto_attrs_in_word and "alto-vpos" in word.attrib:
-                        zone.attrib["lry"] = str(float(word.attrib["alto-vpos"]) + float(word.attrib["alto-height"]))
-                    word_id += 1
-            for attr in default_alto_config:
-                if attr in word.attrib:
-                    word.attrib.pop(attr)
+                        surface_attrs["start"] = "#%s" % elem.attrib[attr]
+            elif elem.tag == "w" and any(attr in elem.attrib for attr in self.zone_attributes):
+                zoned_words += 1
+            if parents:
+                # earlier siblings are already removed
+                del parents[-1][0]
+        return surface_attrs, zoned_words
 
-            # For all possible UDPipe attributes
-            for prop in default_config["UDPipe"]:
-                # If is not in config, remove it from the word
-                if prop not in config["UDPipe"] and prop in word.attrib:
-                    word.attrib.pop(prop)
+    def write(self, stream: BinaryIO, writer: XMLStreamWriter, zone_writers: Tuple[XMLStreamWriter, ...] = None,
+              word_ids: Iterator[int] = None, punctuation_ids: Iterator[int] = None) -> int:
+        """
+        Filter a TEI page while it is parsed and write it, the output is the same as writing the page after `apply`
 
-        # Find all NameTag elements and remove them
-        recursive_remove_name_tag(page_element, name_tag_properties_to_remove)
+        Words and punctuation are written as soon as they are parsed and are then dropped, so only the ancestors of
+        the current element are held in memory.
 
-        body.append(page_element)
-    return tei
+        :param stream: the TEI page
+        :param writer: writer of the page
+        :param zone_writers: writers of the zones of the words and of the punctuation, None if zones are not written
+        :param word_ids: numbers of the `W-n` ids of the words with zones
+        :param punctuation_ids: numbers of the `W-n` ids of the punctuation with zones
+        :returns: the number of words and punctuation
+        """
+        tokens = 0
+        # [element, start tag written, unwrapped NameTag element]
+        frames = []
+        tail = None
+        word_depth = 0
+
+        def open_frames():
+            for frame in frames:
+                if not frame[1] and not frame[2]:
+                    writer.start_element(frame[0])
+                    if frame[0].text:
+                        writer.text(frame[0].text)
+                    frame[1] = True
+
+        for event, elem in iterparse(stream, ("start", "end")):
+            if tail is not None:
+                # the tail of the last written element is complete once the next element starts or its parent ends
+                if tail.tail:
+                    writer.text(tail.tail)
+                tail = None
+            tag = elem.tag
+            if event == "start":
+                if word_depth or tag == "w" or tag == "pc":
+                    word_depth += 1
+                    continue
+                ana = elem.get("ana")
+                unwrapped = ana is not None and ana[:9].lower() == "#nametag-" and \
+                    ana[9:10].lower() in self.name_tag_properties_to_remove
+                frames.append([elem, False, unwrapped])
+                continue
+
+            if word_depth:
+                word_depth -= 1
+                if word_depth:
+                    continue
+                tokens += 1
+                zoned = None
+                if zone_writers is not None:
+                    zoned = []
+                    self._filter_word(elem, zoned)
+                else:
+                    self._filter_word(elem, None)
+                ana = elem.get("ana")
+                if ana is not None and ana[:9].lower() == "#nametag-" and \
+                        ana[9:10].lower() in self.name_tag_properties_to_remove:
+                    del elem.attrib["ana"]
+                if zoned:
+                    current_word_id = "W-" + str(next(word_ids if tag == "w" else punctuation_ids))
+                    elem.attrib["xml:id"] = current_word_id
+                    zone = Element("zone", {"start": "#" + current_word_id})
+                    zone.attrib.update(zoned[0][1])
+                    zone_writers[0 if tag == "w" else 1].element(zone)
+                open_frames()
+                writer.element(elem)
+                tail = elem
+            else:
+                elem, written, unwrapped = frames.pop()
+                if written:
+                    writer.end()
+                elif not unwrapped:
+                    open_frames()
+                    writer.element(elem)
+                if not unwrapped:
+                    tail = elem
+            if frames:
+                # earlier siblings are already removed
+                del frames[-1][0][0]
+        return tokens
+
+    def _filter_word(self, word: Element, zoned: Optional[list]):
+        attrib = word.attrib
+        if zoned is not None:
+            for attr in self.zone_attributes:
+                if attr in attrib:
+                    zoned.append((word, self._zone_attributes(attrib)))
+                    break
+        for attr in self.removed_attributes:
+            if attr in attrib:
+                del attrib[attr]
+
+    def _zone_attributes(self, attrib: dict) -> dict:
+        zone_attrs = {}
+        if self.ulx and "alto-hpos" in attrib:
+            zone_attrs["ulx"] = attrib["alto-hpos"]
+        if self.uly and "alto-vpos" in attrib:
+            zone_attrs["uly"] = attrib["alto-vpos"]
+        if self.lrx and "alto-width" in attrib and "alto-hpos" in attrib:
+            zone_attrs["lrx"] = str(float(attrib["alto-hpos"]) + float(attrib["alto-width"]))
+        if self.lry and "alto-height" in attrib and "alto-vpos" in attrib:
+            zone_attrs["lry"] = str(float(attrib["alto-vpos"]) + float(attrib["alto-height"]))
+        return zone_attrs
+
+
+@lru_cache(maxsize=32)
+def _compile_page_filter(name_tag: tuple, udpipe: tuple, alto: tuple) -> PageFilter:
+    return PageFilter({"NameTag": name_tag, "UDPipe": udpipe, "ALTO": alto})
 
 
-def recursive_remove_name_tag(element: Element, properties: List[str]):
-    i = 0
-    for sub in list(element):
-        recursive_remove_name_tag(sub, properties)
-        if 'ana' in sub.attrib:
-            ana_prop = sub.attrib.get('ana').lower()
-            if ana_prop.startswith('#nametag-') and ana_prop[9] in properties:
-                for sub_sub in list(sub):
-                    element.insert(i, sub_sub)
-                    i += 1
-                element.remove(sub)
-                i -= 1
-        i += 1
+def compile_page_filter(config: dict) -> PageFilter:
+    """Return the page filter of a prepared configuration, compiled once for equal configurations"""
+    return _compile_page_filter(tuple(config["NameTag"]), tuple(config["UDPipe"]), tuple(config["ALTO"]))
@@ -0,0 +1,43 @@
+"""
+Gunicorn configuration of the production server, started with `gunicorn app:app`
+
+The settings are read from environment variables, the defaults are sized to the CPUs available to the container.
+"""
+import os
+
+
+def cpu_count() -> int:
+    """CPUs available to this process, limited by the CFS quota of the container if there is one"""
+    try:
+        count = len(os.sched_getaffinity(0))
+    except AttributeError:
+        count = os.cpu_count() or 1
+    try:
+        with open("/sys/fs/cgroup/cpu.max") as cpu_max:
+            quota, period = cpu_max.read().split()
+        if quota != "max":
+            count = min(count, max(1, int(quota) // int(period)))
+    except (OSError, ValueError):
+        pass
+    return count
+
+
+# The app and the compiled validation schema are loaded once and shared by the forked workers
+os.environ.setdefault("TEI_PRELOAD_SCHEMA", "true")
+preload_app = True
+
+bind = os.environ.get("TEI_BIND", "0.0.0.0:5000")
+# Conversions are CPU-bound, one process per CPU, threads only overlap reading of uploads and writing of responses
+workers = int(os.environ.get("TEI_WORKERS", cpu_count()))
+threads = int(os.environ.get("TEI_THREADS", 2))
+# Keep-alive is supported by the threaded worker only, it is used whenever threads > 1
+keepalive = int(os.environ.get("TEI_KEEPALIVE", 5))
+timeout = int(os.environ.get("TEI_TIMEOUT", 300))
+graceful_timeout = int(os.environ.get("TEI_GRACEFUL_TIMEOUT", 60))
+# Workers are restarted after this many requests to return memory held after large merges, 0 disables restarts
+max_requests = int(os.environ.get("TEI_MAX_REQUESTS", 500))
+max_requests_jitter = int(os.environ.get("TEI_MAX_REQUESTS_JITTER", max_requests // 10))
+
+accesslog = os.environ.get("TEI_ACCESS_LOG", "-")
+errorlog = "-"
+loglevel = os.environ.get("TEI_LOG_LEVEL", "info")
@@ -0,0 +1,281 @@
+"""
+Merge jobs processed in the background
+
+A job is a directory holding the uploaded header and pages, the options of the merge, the merged document and a
+`status.json` file. The state is kept only in the files, so any worker of the server can queue a job, report its
+status and return its result. The jobs are merged by a job runner, a separate process started by the first worker
+which needs it and holding a lock in the job directory, so there is one runner per job directory. The runner merges at
+most `TEI_JOB_WORKERS` jobs at once in its own processes, they do not share the workers' CPU time and are not
+interrupted when a worker is restarted. The runner exits when there have been no jobs for a while. A running job of a
+runner which has exited is reported as failed.
+
+    python jobs.py
+"""
+import fcntl
+import json
+import logging
+import os
+import re
+import shutil
+import subprocess
+import sys
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from datetime import datetime
+from multiprocessing import get_context
+from threading import Lock
+from time import time, monotonic, sleep
+from typing import List, Optional, Iterator
+from uuid import uuid4
+from werkzeug.datastructures import FileStorage
+from werkzeug.exceptions import HTTPException
+from converter import stream_tei_document
+from settings import JOB_DIR, JOB_WORKERS, JOB_RETENTION
+
+JOB_ID = re.compile(r"^[0-9a-f]{32}$")
+STATUS_FILE = "status.json"
+OPTIONS_FILE = "options.json"
+RESULT_FILE = "result.xml"
+RUNNER_LOCK_FILE = ".runner.lock"
+# Minimal number of seconds between writes of the progress of a job
+PROGRESS_INTERVAL = 1.0
+# Seconds between the scans of the job directory for queued jobs by the runner
+POLL_INTERVAL = 1.0
+# Seconds without any queued or running job after which the runner exits
+RUNNER_IDLE_TIMEOUT = 60.0
+
+logger = logging.getLogger("jobs")
+
+
+def now() -> str:
+    return datetime.now().strftime('%Y-%m-%dT%H:%M:%S')
+
+
+def process_exists(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class MergeJobs:
+    """
+    Merges queued in `directory` and run by the job runner of the directory
+
+    :param directory: directory of the jobs, created on first use
+    :param workers: number of jobs merged at once by the runner, further jobs are queued
+    :param retention: seconds a finished job and its result are kept, removed when a new job is submitted
+    """
+
+    def __init__(self, directory: str, workers: int, retention: int):
+        self.directory = directory
+        self.workers = workers
+        self.retention = retention
+        self._runner = None
+        self._lock = Lock()
+
+    def submit(self, header: FileStorage, pages: List[FileStorage], config: dict, pretty: bool = True) -> dict:
+        """Save the uploaded files of a merge and queue it, see `stream_tei_document`"""
+        self.cleanup()
+        job_id = uuid4().hex
+        path = self._path(job_id)
+        os.makedirs(path)
+        header.save(os.path.join(path, "header"))
+        for index, page in enumerate(pages):
+            page.save(os.path.join(path, "page-%06d" % index))
+        with open(os.path.join(path, OPTIONS_FILE), "w", encoding="utf-8") as options:
+            json.dump({"config": config, "pretty": pretty}, options)
+        status = {
+            "id": job_id,
+            "status": "queued",
+            "pages_done": 0,
+            "pages_total": len(pages),
+            "created": now(),
+            "finished": None,
+            "error": None,
+            "pid": None
+        }
+        # the runner picks the job once its status is written
+        self._write_status(job_id, status)
+        self.start_runner()
+        return status
+
+    def status(self, job_id: str) -> Optional[dict]:
+        """Status of a job, None if there is no such job"""
+        if not JOB_ID.match(job_id):
+            return None
+        status = self._read_status(job_id)
+        if status is None:
+            return None
+        if status["status"] == "running" and not process_exists(status["pid"]):
+            status["status"] = "failed"
+            status["error"] = {"code": 500, "name": "Internal Server Error",
+                               "description": "The process merging the job has exited."}
+        elif status["status"] == "queued":
+            # a runner exiting when the job was queued did not see it
+            self.start_runner()
+        return status
+
+    def result_path(self, job_id: str) -> str:
+        return os.path.join(self._path(job_id), RESULT_FILE)
+
+    def cleanup(self):
+        """Remove the finished jobs older than the retention"""
+        limit = time() - self.retention
+        for job_id in self._job_ids():
+            status = self.status(job_id)
+            if status is None or status["status"] not in ("done", "failed"):
+                continue
+            try:
+                if os.stat(os.path.join(self._path(job_id), STATUS_FILE)).st_mtime < limit:
+                    shutil.rmtree(self._path(job_id), ignore_errors=True)
+            except OSError:
+                pass
+
+    def start_runner(self):
+        """Start the job runner of the directory in a new process unless it is running"""
+        with self._lock:
+            if self._runner is not None and self._runner.poll() is None:
+                return
+            if self._runner_lock() is None:
+                return
+            # the runner outlives this worker, it is not stopped with the worker's process group
+            self._runner = subprocess.Popen([sys.executable, os.path.abspath(__file__)], stdin=subprocess.DEVNULL,
+                                            cwd=os.path.dirname(os.path.abspath(__file__)), start_new_session=True,
+                                            env=dict(os.environ, TEI_JOB_DIR=self.directory,
+                                                     TEI_JOB_WORKERS=str(self.workers)))
+
+    def run_runner(self):
+        """
+        Merge the queued jobs, at most `workers` at once, until there have been none for `RUNNER_IDLE_TIMEOUT`
+
+        Returns immediately if another runner holds the lock of the directory.
+        """
+        lock = self._runner_lock(keep=True)
+        if lock is None:
+            return
+        logger.info("Job runner %d started in %s with %d workers", os.getpid(), self.directory, self.workers)
+        running = {}
+        idle_since = monotonic()
+        try:
+            # spawned processes do not inherit the lock, it is released as soon as the runner exits
+            with ProcessPoolExecutor(max_workers=self.workers, mp_context=get_context("spawn")) as executor:
+                while running or monotonic() - idle_since < RUNNER_IDLE_TIMEOUT:
+                    for job_id in self._queued_job_ids():
+                        if len(running) >= self.workers:
+                            break
+                        if job_id not in running:
+                            running[job_id] = executor.submit(run_job, self.directory, job_id)
+                    if running:
+                        done, _ = wait(running.values(), timeout=POLL_INTERVAL, return_when=FIRST_COMPLETED)
+                        running = {job_id: future for job_id, future in running.items() if future not in done}
+                        idle_since = monotonic()
+                    else:
+                        sleep(POLL_INTERVAL)
+        finally:
+            lock.close()
+        logger.info("Job runner %d exited", os.getpid())
+
+    def run(self, job_id: str):
+        """Merge a queued job and write its result and status, a job which is not queued is left as it is"""
+        path = self._path(job_id)
+        status = self._read_status(job_id)
+        if status is None or status["status"] != "queued":
+            return
+        page_files = sorted(os.path.join(path, name) for name in os.listdir(path) if name.startswith("page-"))
+        status["status"] = "running"
+        status["pid"] = os.getpid()
+        self._write_status(job_id, status)
+        try:
+            with open(os.path.join(path, OPTIONS_FILE), encoding="utf-8") as options_file:
+                options = json.load(options_file)
+            with open(os.path.join(path, "header"), "rb") as header, \
+                    open(os.path.join(path, RESULT_FILE + ".part"), "wb") as result:
+                pages = self._open_pages(status, page_files)
+                for chunk in stream_tei_document(FileStorage(header, "header"), pages, options["config"],
+                                                 options["pretty"]):
+                    result.write(chunk)
+            os.replace(os.path.join(path, RESULT_FILE + ".part"), self.result_path(job_id))
+            status["status"] = "done"
+        except HTTPException as e:
+            status["status"] = "failed"
+            status["error"] = {"code": e.code, "name": e.name, "description": e.description}
+        except Exception as e:
+            status["status"] = "failed"
+            status["error"] = {"code": 500, "name": "Internal Server Error", "description": str(e)}
+        finally:
+            for page_file in page_files:
+                if os.path.exists(page_file):
+                    os.remove(page_file)
+        status["finished"] = now()
+        self._write_status(job_id, status)
+
+    def _open_pages(self, status: dict, page_files: List[str]) -> Iterator[FileStorage]:
+        """Open the pages one by one and record the progress, a page is done when the next one is requested"""
+        written = monotonic()
+        for index, page_file in enumerate(page_files):
+            status["pages_done"] = index
+            if monotonic() - written >= PROGRESS_INTERVAL:
+                self._write_status(status["id"], status)
+                written = monotonic()
+            yield FileStorage(open(page_file, "rb"), os.path.basename(page_file))
+        status["pages_done"] = len(page_files)
+
+    def _job_ids(self) -> List[str]:
+        try:
+            return [job_id for job_id in os.listdir(self.directory) if JOB_ID.match(job_id)]
+        except FileNotFoundError:
+            return []
+
+    def _queued_job_ids(self) -> List[str]:
+        """Queued jobs in the order they were created"""
+        queued = []
+        for job_id in self._job_ids():
+            status = self._read_status(job_id)
+            if status is not None and status["status"] == "queued":
+                queued.append((status["created"], job_id))
+        return [job_id for _, job_id in sorted(queued)]
+
+    def _runner_lock(self, keep: bool = False):
+        """Open file of the runner lock if no runner holds it, the lock is released at once unless `keep`"""
+        os.makedirs(self.directory, exist_ok=True)
+        lock = open(os.path.join(self.directory, RUNNER_LOCK_FILE), "a")
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            lock.close()
+            return None
+        if not keep:
+            lock.close()
+        return lock
+
+    def _read_status(self, job_id: str) -> Optional[dict]:
+        try:
+            with open(os.path.join(self._path(job_id), STATUS_FILE), encoding="utf-8") as status_file:
+                return json.load(status_file)
+        except (OSError, ValueError):
+            return None
+
+    def _write_status(self, job_id: str, status: dict):
+        status_file = os.path.join(self._path(job_id), STATUS_FILE)
+        with open(status_file + ".tmp", "w", encoding="utf-8") as tmp:
+            json.dump(status, tmp)
+        os.replace(status_file + ".tmp", status_file)
+
+    def _path(self, job_id: str) -> str:
+        return os.path.join(self.directory, job_id)
+
+
+merge_jobs = MergeJobs(JOB_DIR, JOB_WORKERS, JOB_RETENTION)
+
+
+def run_job(directory: str, job_id: str):
+    """Merge a job in a process of the runner"""
+    MergeJobs(directory, 1, JOB_RETENTION).run(job_id)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(levelname)s %(message)s")
+    merge_jobs.run_runner()
@@ -0,0 +1,129 @@
+"""
+Incremental reading of Kramerius+ page objects
+
+`read_page` reads a page object from a stream without decoding it as a whole. The tokens are decoded one at a time
+and added to the columns of `tokens.PageTokens`, which keep only the fields used by `converter.generate_tei_page`,
+so the dictionary of a token is released as soon as the next one is decoded.
+"""
+import codecs
+import re
+from json import JSONDecoder, JSONDecodeError
+from typing import BinaryIO, Iterator, Any
+from werkzeug.exceptions import BadRequest
+from tokens import PageTokens, InternTable
+
+CHUNK_SIZE = 64 * 1024
+WHITESPACE = re.compile(r"[ \t\n\r]*")
+
+
+class JSONReader:
+    """
+    Pull reader of the structure of a JSON document read from a binary stream in chunks
+
+    Only the part of the document which has not been read yet is buffered, values are decoded with the standard
+    decoder.
+    """
+
+    def __init__(self, stream: BinaryIO):
+        self.stream = stream
+        self.text_decoder = codecs.getincrementaldecoder("utf-8-sig")()
+        self.decoder = JSONDecoder()
+        self.buffer = ""
+        self.position = 0
+        self.eof = False
+
+    def _fill(self, size: int = CHUNK_SIZE) -> bool:
+        """Read more data, False at the end of the stream"""
+        if self.eof:
+            return False
+        data = self.stream.read(size)
+        self.buffer = self.buffer[self.position:] + self.text_decoder.decode(data, not data)
+        self.position = 0
+        if not data:
+            self.eof = True
+        return True
+
+    def peek(self) -> str:
+        """Next character which is not whitespace, an empty string at the end of the document"""
+        while True:
+            self.position = WHITESPACE.match(self.buffer, self.position).end()
+            if self.position < len(self.buffer):
+                return self.buffer[self.position]
+            if not self._fill():
+                return ""
+
+    def expect(self, characters: str) -> str:
+        character = self.peek()
+        if not character or character not in characters:
+            self.error("Expecting one of '%s'" % characters)
+        self.position += 1
+        return character
+
+    def value(self) -> Any:
+        """Decode the next value"""
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.position)
+                # a number is complete only if it is followed by another character
+                if end < len(self.buffer) or self.eof:
+                    self.position = end
+                    return value
+            except JSONDecodeError as e:
+                if self.eof:
+                    raise BadRequest(description="Invalid JSON: %s" % e)
+            # the value is not complete, read at least as much as is buffered
+            self._fill(max(CHUNK_SIZE, len(self.buffer) - self.position))
+
+    def items(self) -> Iterator[str]:
+        """Keys of the object starting at the current position, the caller reads the value of each key"""
+        self.expect("{")
+        if self.peek() == "}":
+            self.position += 1
+            return
+        while True:
+            key = self.value()
+            if not isinstance(key, str):
+                self.error("Expecting property name")
+            self.expect(":")
+            yield key
+            if self.expect(",}") == "}":
+                return
+
+    def elements(self) -> Iterator[Any]:
+        """Values of the array starting at the current position"""
+        self.expect("[")
+        if self.peek() == "]":
+            self.position += 1
+            return
+        while True:
+            yield self.value()
+            if self.expect(",]") == "]":
+                return
+
+    def end(self):
+        if self.peek():
+            self.error("Extra data")
+
+    def error(self, message: str):
+        raise BadRequest(description="Invalid JSON: %s at character %d of the buffered data" % (message, self.position))
+
+
+def read_page(stream: BinaryIO, intern: InternTable = None) -> dict:
+    """
+    Read a page object, see `converter.generate_tei_page`, with its tokens stored in `PageTokens`
+
+    The strings of the tokens are added to `intern` if given, to be shared with other pages converted with it. Errors
+    in the JSON document and invalid tokens are raised as BadRequest.
+    """
+    reader = JSONReader(stream)
+    if reader.peek() != "{":
+        reader.error("Expecting a page object")
+    page = {}
+    for key in reader.items():
+        if key == "tokens" and reader.peek() == "[":
+            page[key] = PageTokens.from_tokens(reader.elements(), intern)
+        else:
+            page[key] = reader.value()
+    reader.end()
+    return page
@@ -0,0 +1,165 @@
+"""
+Metrics of the conversions in the Prometheus text format and per-request stage timings for the `Server-Timing` header
+
+Nothing is recorded unless metrics or server timing are enabled in the settings. The metrics are kept per process,
+every worker of the server reports its own.
+"""
+from bisect import bisect_left
+from functools import wraps
+from threading import Lock
+from time import perf_counter
+from typing import Tuple, Dict, List
+from flask import g, has_request_context
+from settings import METRICS_ENABLED, SERVER_TIMING
+
+ENABLED = METRICS_ENABLED or SERVER_TIMING
+DURATION_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+SIZE_BUCKETS = (1024, 10 * 1024, 100 * 1024, 1024 ** 2, 10 * 1024 ** 2, 100 * 1024 ** 2)
+
+
+def format_labels(names: Tuple[str, ...], values: Tuple[str, ...], extra: str = None) -> str:
+    labels = ['%s="%s"' % (name, str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+              for name, value in zip(names, values)]
+    if extra:
+        labels.append(extra)
+    return "{%s}" % ",".join(labels) if labels else ""
+
+
+class Counter:
+    def __init__(self, name: str, description: str, labels: Tuple[str, ...] = ()):
+        self.name = name
+        self.description = description
+        self.labels = labels
+        self._values = {}
+        self._lock = Lock()
+
+    def inc(self, amount: float = 1, *label_values: str):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def render(self) -> List[str]:
+        lines = ["# HELP %s %s" % (self.name, self.description), "# TYPE %s counter" % self.name]
+        with self._lock:
+            for label_values, value in sorted(self._values.items()):
+                lines.append("%s%s %s" % (self.name, format_labels(self.labels, label_values), value))
+        return lines
+
+
+class Histogram:
+    def __init__(self, name: str, description: str, labels: Tuple[str, ...] = (),
+                 buckets: Tuple[float, ...] = DURATION_BUCKETS):
+        self.name = name
+        self.description = description
+        self.labels = labels
+        self.buckets = buckets
+        # label values -> [counts of the buckets and +Inf, sum]
+        self._values = {}
+        self._lock = Lock()
+
+    def observe(self, value: float, *label_values: str):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(label_values)
+            if entry is None:
+                entry = self._values[label_values] = [[0] * (len(self.buckets) + 1), 0]
+            entry[0][index] += 1
+            entry[1] += value
+
+    def render(self) -> List[str]:
+        lines = ["# HELP %s %s" % (self.name, self.description), "# TYPE %s histogram" % self.name]
+        with self._lock:
+            for label_values, (counts, total) in sorted(self._values.items()):
+                cumulative = 0
+                for bound, count in zip(self.buckets + ("+Inf",), counts):
+                    cumulative += count
+                    labels = format_labels(self.labels, label_values, 'le="%s"' % bound)
+                    lines.append("%s_bucket%s %d" % (self.name, labels, cumulative))
+                labels = format_labels(self.labels, label_values)
+                lines.append("%s_sum%s %s" % (self.name, labels, total))
+                lines.append("%s_count%s %d" % (self.name, labels, cumulative))
+        return lines
+
+
+STAGE_SECONDS = Histogram("tei_stage_duration_seconds", "Duration of processing stages.", ("stage",))
+REQUEST_SECONDS = Histogram("tei_request_duration_seconds", "Duration of requests including streaming.",
+                            ("endpoint", "code"))
+RESPONSE_BYTES = Histogram("tei_response_bytes", "Size of response bodies.", ("endpoint",), SIZE_BUCKETS)
+PAGES = Counter("tei_pages_total", "Converted or merged pages.", ("operation",))
+TOKENS = Counter("tei_tokens_total", "Tokens of converted or merged pages.", ("operation",))
+PAGE_CACHE_REQUESTS = Counter("tei_page_cache_requests_total", "Lookups of converted pages in the page cache.",
+                              ("result",))
+REGISTRY = (STAGE_SECONDS, REQUEST_SECONDS, RESPONSE_BYTES, PAGES, TOKENS, PAGE_CACHE_REQUESTS)
+
+
+def render_metrics() -> str:
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+def record_stage(name: str, seconds: float):
+    if METRICS_ENABLED:
+        STAGE_SECONDS.observe(seconds, name)
+    if SERVER_TIMING and has_request_context():
+        timings = g.setdefault("server_timing", {})
+        timings[name] = timings.get(name, 0) + seconds
+
+
+def record_pages(operation: str, pages: int, tokens: int):
+    if METRICS_ENABLED:
+        PAGES.inc(pages, operation)
+        TOKENS.inc(tokens, operation)
+
+
+def record_page_cache(hit: bool):
+    if METRICS_ENABLED:
+        PAGE_CACHE_REQUESTS.inc(1, "hit" if hit else "miss")
+
+
+def record_request(endpoint: str, code: int, seconds: float, size: int = None):
+    if METRICS_ENABLED:
+        REQUEST_SECONDS.observe(seconds, endpoint, str(code))
+        if size is not None:
+            RESPONSE_BYTES.observe(size, endpoint)
+
+
+def server_timing() -> Dict[str, float]:
+    """Stage durations of the current request in seconds"""
+    return g.get("server_timing", {})
+
+
+class stage:
+    """
+    Measure the duration of a block as a processing stage
+
+        with stage("parse"):
+            ...
+    """
+    __slots__ = ("name", "start")
+
+    def __init__(self, name: str):
+        self.name = name
+
+    def __enter__(self):
+        if ENABLED:
+            self.start = perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if ENABLED:
+            record_stage(self.name, perf_counter() - self.start)
+
+
+def timed(name: str):
+    """Measure the duration of every call of the decorated function as a processing stage"""
+    def decorator(function):
+        if not ENABLED:
+            return function
+
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            with stage(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
@@ -1,5 +1,11 @@
 from werkzeug.datastructures import FileStorage
 
+COMPACT_HELP = 'Ak je `true`, XML v odpovedi nie je odsadené (kompaktný výstup).'
+PAGE_FORMAT_HELP = 'Formát odpovede: `xml` (predvolený) alebo `binary` (kompaktný binárny formát stránky, ktorý ' \
+                   'je možné nahrať do `POST /merge` namiesto XML).'
+PAGES_FORMAT_HELP = 'Formát odpovede: `xml` (stránky v elemente `pages`, predvolený) alebo `ndjson` (jeden JSON ' \
+                    'objekt na riadok).'
+
 
 def generate_page_model(api):
     return api.schema_model('Page', {
@@ -103,6 +109,16 @@ def generate_page_model(api):
     })
 
 
+def generate_pages_model(api):
+    return api.schema_model('Pages', {
+        "type": "array",
+        "description": "Pole stránok, prípadne stránky ako NDJSON (`Content-Type: application/x-ndjson`)",
+        "items": {
+            "$ref": "#/definitions/Page"
+        }
+    })
+
+
 def generate_header_model(api):
     return api.schema_model('Header', {
         "type": "object",
@@ -246,21 +262,91 @@ def generate_header_model(api):
     })
 
 
+def generate_document_model(api):
+    return api.schema_model('Document', {
+        "type": "object",
+        "required": [
+            "header",
+            "pages"
+        ],
+        "properties": {
+            "header": {
+                "$ref": "#/definitions/Header"
+            },
+            "pages": {
+                "type": "array",
+                "description": "Stránky dokumentu v poradí, v akom majú byť v dokumente",
+                "items": {
+                    "$ref": "#/definitions/Page"
+                }
+            },
+            "NameTag": {
+                "type": "string",
+                "description": "Filtrácia NameTag rozpoznaných entít. Uveďte zoznam skupín entít, ktoré majú byť "
+                               "zachované. Zoznam podporovaných skupín: `a,g,i,m,n,o,p,t`"
+            },
+            "UDPipe": {
+                "type": "string",
+                "description": "Filtrácia UDPipe rozpoznaných atribútov. Uveďte zoznam (oddelené čiarkou) "
+                               "atribútov, ktoré majú byť zachované. Zoznam podporovaných atribútov: "
+                               "`n,lemma,pos,msd,join`"
+            },
+            "ALTO": {
+                "type": "string",
+                "description": "Filtrácia ALTO rozpoznaných atribútov. Uveďte zoznam (oddelené čiarkou) atribútov, "
+                               "ktoré majú byť zachované. Zoznam podporovaných atribútov: `width,height,vpos,hpos`"
+            }
+        }
+    })
+
+
+def add_filter_arguments(parser):
+    parser.add_argument('NameTag', type=str, location='form',
+                        help='Filtrácia NameTag rozpoznaných entít. Uveďte zoznam skupín entít, ktoré majú byť '
+                             'zachované. Zoznam podporovaných skupín: `a,g,i,m,n,o,p,t`')
+    parser.add_argument('UDPipe', type=str, location='form',
+                        help='Filtrácia UDPipe rozpoznaných atribútov. Uveďte zoznam (oddelené čiarkou) '
+                             'atribútov, ktoré majú byť zachované. Zoznam podporovaných atribútov: '
+                             '`n,lemma,pos,msd,join`')
+    parser.add_argument('ALTO', type=str, location='form',
+                        help='Filtrácia ALTO rozpoznaných atribútov. Uveďte zoznam (oddelené čiarkou) atribútov, '
+                             'ktoré majú byť zachované. Zoznam podporovaných atribútov: `width,height,vpos,hpos`')
+
+
 def generate_merge_parser(api):
     merge_parser = api.parser()
     merge_parser.add_argument('header', location='files', type=FileStorage, required=True,
                               help='TEI hlavička dokumentu vygenerovaná službou `POST /convert/header`')
     merge_parser.add_argument('page[]', location='files', type=FileStorage, required=True,
-                              help='TEI stránok dokumentu vygenerované službou `POST /convert/page`. Môže byť '
-                                   'vložených opakovane pre zlúčenie viac stránok do dokumentu')
-    merge_parser.add_argument('NameTag', type=str, location='form',
-                              help='Filtrácia NameTag rozpoznaných entít. Uveďte zoznam skupín entít, ktoré majú byť '
-                                   'zachované. Zoznam podporovaných skupín: `a,g,i,m,n,o,p,t`')
-    merge_parser.add_argument('UDPipe', type=str, location='form',
-                              help='Filtrácia UDPipe rozpoznaných atribútov. Uveďte zoznam (oddelené čiarkou) '
-                                   'atribútov, ktoré majú byť zachované. Zoznam podporovaných atribútov: '
-                                   '`n,lemma,pos,msd,join`')
-    merge_parser.add_argument('ALTO', type=str, location='form',
-                              help='Filtrácia ALTO rozpoznaných atribútov. Uveďte zoznam (oddelené čiarkou) atribútov, '
-                                   'ktoré majú byť zachované. Zoznam podporovaných atribútov: `width,height,vpos,hpos`')
+                              help='TEI stránok dokumentu vygenerované službou `POST /convert/page` vo formáte XML '
+                                   'alebo `binary`. Môže byť vložených opakovane pre zlúčenie viac stránok do '
+                                   'dokumentu')
+    add_filter_arguments(merge_parser)
+    merge_parser.add_argument('stream', type=str, location='form',
+                              help='Ak je `true`, dokument je generovaný a odosielaný postupne po stránkach bez '
+                                   'načítania celého dokumentu do pamäte. Takto vygenerovaný dokument nie je '
+                                   'validovaný.')
     return merge_parser
+
+
+def generate_job_parser(api):
+    job_parser = api.parser()
+    job_parser.add_argument('header', location='files', type=FileStorage, required=True,
+                            help='TEI hlavička dokumentu vygenerovaná službou `POST /convert/header`')
+    job_parser.add_argument('page[]', location='files', type=FileStorage, required=True,
+                            help='TEI stránok dokumentu vygenerované službou `POST /convert/page` vo formáte XML '
+                                 'alebo `binary`. Môže byť vložených opakovane pre zlúčenie viac stránok do '
+                                 'dokumentu')
+    add_filter_arguments(job_parser)
+    return job_parser
+
+
+def generate_append_parser(api):
+    append_parser = api.parser()
+    append_parser.add_argument('document', location='files', type=FileStorage, required=True,
+                               help='TEI dokument vygenerovaný službou `POST /merge`, ku ktorému sú stránky pridané')
+    append_parser.add_argument('page[]', location='files', type=FileStorage, required=True,
+                               help='Nové TEI stránky dokumentu vygenerované službou `POST /convert/page` vo formáte '
+                                    'XML alebo `binary`. Môže byť vložených opakovane pre pridanie viac stránok')
+    add_filter_arguments(append_parser)
+    return append_parser
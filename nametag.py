@@ -0,0 +1,89 @@
+import json
+from typing import Callable, Dict
+from xml.etree.ElementTree import Element, SubElement
+from settings import NAMETAG_MAPPING_FILE
+from utils import month_to_number
+
+# Creates the element of a NameTag group under the parent element from the token starting the group
+ElementFactory = Callable[[Element, dict], Element]
+
+
+def day_attributes(token: dict) -> dict:
+    try:
+        return {"when": "---%02d" % int(token["content"])}
+    except ValueError:
+        return {}
+
+
+def month_attributes(token: dict) -> dict:
+    month = month_to_number(token["linguisticMetadata"]["lemma"])
+    try:
+        return {"when": "--%02d" % int(month)}
+    except ValueError:
+        return {}
+
+
+def year_attributes(token: dict) -> dict:
+    return {"when": token["content"]}
+
+
+def target_attributes(token: dict) -> dict:
+    return {"target": token["content"]}
+
+
+# Handlers computing attributes of a group element from the token, referenced by name in the mapping file
+HANDLERS = {
+    "day": day_attributes,
+    "month": month_attributes,
+    "year": year_attributes,
+    "target": target_attributes,
+}
+
+
+def compile_factory(grp_name: str, entry: dict) -> ElementFactory:
+    """
+    Compile one entry of the NameTag mapping into an element factory
+
+    :param grp_name: NameTag category, e.g. `gc`
+    :param entry:
+        {
+            'tag': str,         # element of the category
+            'attrs': dict,      # fixed attributes of the element
+            'wrapper': str,     # element wrapping the element, e.g. `placeName` around `country`
+            'handler': str      # name of a handler in HANDLERS computing attributes from the token
+        }
+    :returns: a function creating the (innermost) element of the category
+    """
+    tag = entry["tag"]
+    fixed_attrs = entry.get("attrs", {})
+    ana = {"ana": "#nametag-" + grp_name}
+    attrs = {**fixed_attrs, **ana}
+
+    if "handler" in entry:
+        handler = HANDLERS[entry["handler"]]
+
+        def factory(parent: Element, token: dict) -> Element:
+            return SubElement(parent, tag, {**fixed_attrs, **handler(token), **ana})
+    elif "wrapper" in entry:
+        wrapper = entry["wrapper"]
+
+        def factory(parent: Element, token: dict) -> Element:
+            return SubElement(SubElement(parent, wrapper, ana), tag, attrs)
+    else:
+        def factory(parent: Element, token: dict) -> Element:
+            return SubElement(parent, tag, attrs)
+    return factory
+
+
+def load_name_tag_mapping(path: str = NAMETAG_MAPPING_FILE) -> Dict[str, ElementFactory]:
+    with open(path, encoding="utf-8") as file:
+        mapping = json.load(file)
+    return {grp_name: compile_factory(grp_name, entry) for grp_name, entry in mapping.items()}
+
+
+def create_group(parent: Element, grp_name: str) -> Element:
+    """Create an element of a NameTag category without an entry in the mapping"""
+    return SubElement(parent, "group", {"type": grp_name, "ana": "#nametag-" + grp_name})
+
+
+NAME_TAG_FACTORIES = load_name_tag_mapping()
@@ -0,0 +1,130 @@
+"""
+Cache of converted pages keyed by a hash of the Kramerius+ page object
+
+The same pages are converted again whenever a document is re-exported. With a cache enabled in the settings,
+`convert_tei_page` returns the cached `div` of a page object converted before. The `memory` backend keeps the
+elements in the worker process, the `sqlite` backend keeps them in the binary format of `binary.py` in a database
+file shared by all workers and kept across restarts. Both keep at most the configured number of most recently used
+pages.
+"""
+import json
+import os
+import sqlite3
+from hashlib import sha256
+from threading import Lock
+from time import time_ns
+from typing import Optional
+from xml.etree.ElementTree import Element
+from binary import encode_element, decode_element
+from info import APP_VERSION
+from metrics import record_page_cache
+from settings import PAGE_CACHE, PAGE_CACHE_SIZE, PAGE_CACHE_FILE
+from utils import LRUCache
+
+
+def page_cache_key(page: dict) -> str:
+    """
+    Key of a page object in the page cache
+
+    The version of the converter is part of the key, so pages cached by another version are not returned.
+    """
+    data = json.dumps([APP_VERSION, page], sort_keys=True, default=str)
+    return sha256(data.encode("utf-8")).hexdigest()
+
+
+class MemoryPageCache:
+    """Pages kept in the worker process, the elements are returned as stored and must not be modified"""
+
+    def __init__(self, max_size: int):
+        self._entries = LRUCache(max_size)
+
+    def get(self, key: str) -> Optional[Element]:
+        return self._entries.get(key)
+
+    def put(self, key: str, elem: Element):
+        self._entries.put(key, elem)
+
+    def clear(self):
+        self._entries.clear()
+
+
+class SQLitePageCache:
+    """
+    Pages kept in an SQLite database file in the binary format
+
+    Every process opens its own connection on first use, so the cache can be created before the workers are forked.
+    The least recently used pages are deleted when a page is added to a full cache.
+    """
+
+    def __init__(self, path: str, max_size: int):
+        self.path = path
+        self.max_size = max_size
+        self._connection = None
+        self._pid = None
+        self._lock = Lock()
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._connection is None or self._pid != os.getpid():
+            self._connection = sqlite3.connect(self.path, timeout=10, check_same_thread=False,
+                                               isolation_level=None)
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute("CREATE TABLE IF NOT EXISTS pages "
+                                     "(key TEXT PRIMARY KEY, data BLOB NOT NULL, used INTEGER NOT NULL)")
+            self._connection.execute("CREATE INDEX IF NOT EXISTS pages_used ON pages (used)")
+            self._pid = os.getpid()
+        return self._connection
+
+    def get(self, key: str) -> Optional[Element]:
+        with self._lock:
+            connection = self._connect()
+            row = connection.execute("SELECT data FROM pages WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            connection.execute("UPDATE pages SET used = ? WHERE key = ?", (time_ns(), key))
+        return decode_element(row[0])
+
+    def put(self, key: str, elem: Element):
+        if self.max_size <= 0:
+            return
+        data = encode_element(elem)
+        with self._lock:
+            connection = self._connect()
+            connection.execute("INSERT OR REPLACE INTO pages (key, data, used) VALUES (?, ?, ?)",
+                               (key, data, time_ns()))
+            excess = connection.execute("SELECT COUNT(*) FROM pages").fetchone()[0] - self.max_size
+            if excess > 0:
+                connection.execute("DELETE FROM pages WHERE key IN "
+                                   "(SELECT key FROM pages ORDER BY used LIMIT ?)", (excess,))
+
+    def clear(self):
+        with self._lock:
+            self._connect().execute("DELETE FROM pages")
+
+
+def create_page_cache(backend: str, max_size: int, path: str = PAGE_CACHE_FILE):
+    """Page cache of the given backend, `memory` or `sqlite`, None if the backend is empty or the size is 0"""
+    if not backend or max_size <= 0:
+        return None
+    if backend == "memory":
+        return MemoryPageCache(max_size)
+    if backend == "sqlite":
+        return SQLitePageCache(path, max_size)
+    raise ValueError("Unknown page cache backend %r, expected `memory` or `sqlite`" % backend)
+
+
+page_cache = create_page_cache(PAGE_CACHE, PAGE_CACHE_SIZE)
+
+
+def get_cached_page(page: dict) -> (Optional[str], Optional[Element]):
+    """Key of a page object and its cached element, (None, None) if the cache is disabled"""
+    if page_cache is None:
+        return None, None
+    key = page_cache_key(page)
+    elem = page_cache.get(key)
+    record_page_cache(elem is not None)
+    return key, elem
+
+
+def put_cached_page(key: Optional[str], elem: Element):
+    if page_cache is not None and key is not None:
+        page_cache.put(key, elem)
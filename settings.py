@@ -0,0 +1,59 @@
+import os
+from tempfile import gettempdir
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def env_bool(name: str, default: bool = False) -> bool:
+    value = os.environ.get(name)
+    if value is None:
+        return default
+    return value.strip().lower() in ("1", "true", "yes", "on")
+
+
+# XSD schema used to validate merged documents
+SCHEMA_FILE = os.environ.get("TEI_SCHEMA_FILE", os.path.join(BASE_DIR, "scheme", "document.xsd"))
+# Compile the schema when the app is imported instead of on the first merge
+PRELOAD_SCHEMA = env_bool("TEI_PRELOAD_SCHEMA")
+# Fraction of merged documents validated against the schema, 0 disables the validation
+VALIDATION_SAMPLE_RATE = float(os.environ.get("TEI_VALIDATION_SAMPLE_RATE", 1.0))
+# Validate merged documents after the response is sent instead of before
+VALIDATE_AFTER_RESPONSE = env_bool("TEI_VALIDATE_AFTER_RESPONSE")
+# Size in bytes up to which the streamed merge keeps page bodies in memory before spooling them to disk
+SPOOL_MAX_SIZE = int(os.environ.get("TEI_SPOOL_MAX_SIZE", 8 * 1024 * 1024))
+# Mapping of NameTag categories to TEI elements
+NAMETAG_MAPPING_FILE = os.environ.get("TEI_NAMETAG_MAPPING_FILE", os.path.join(BASE_DIR, "scheme", "nametag.json"))
+# Number of processes parsing and filtering pages of a merge, pages are processed by the request thread if 1
+MERGE_WORKERS = int(os.environ.get("TEI_MERGE_WORKERS", 1))
+# Number of generated TEI headers kept in memory for re-exports of the same publication, 0 disables the cache
+HEADER_CACHE_SIZE = int(os.environ.get("TEI_HEADER_CACHE_SIZE", 128))
+# Cache of converted pages: empty to disable it, `memory` per worker or `sqlite` in a file shared by the workers
+PAGE_CACHE = os.environ.get("TEI_PAGE_CACHE", "").strip().lower()
+# Number of converted pages kept in the page cache
+PAGE_CACHE_SIZE = int(os.environ.get("TEI_PAGE_CACHE_SIZE", 1024))
+# Database file of the `sqlite` page cache
+PAGE_CACHE_FILE = os.environ.get("TEI_PAGE_CACHE_FILE", os.path.join(gettempdir(), "tei-page-cache.sqlite3"))
+# Directory of the merge jobs, their uploads and results
+JOB_DIR = os.environ.get("TEI_JOB_DIR", os.path.join(gettempdir(), "tei-jobs"))
+# Number of merge jobs processed at once by the job runner of the server, further jobs are queued
+JOB_WORKERS = int(os.environ.get("TEI_JOB_WORKERS", 1))
+# Seconds a finished merge job and its result are kept
+JOB_RETENTION = int(os.environ.get("TEI_JOB_RETENTION", 24 * 60 * 60))
+# Maximum size in bytes of a request body, larger requests are rejected with 413, 0 disables the limit
+MAX_CONTENT_LENGTH = int(os.environ.get("TEI_MAX_CONTENT_LENGTH", 512 * 1024 * 1024)) or None
+# Compress responses with the encoding accepted by the client
+COMPRESS_RESPONSES = env_bool("TEI_COMPRESS_RESPONSES", True)
+# Level of gzip compression of responses, 1 is the fastest, 9 the smallest
+COMPRESSION_LEVEL = int(os.environ.get("TEI_COMPRESSION_LEVEL", 6))
+# Level of zstd compression of responses, 1 is the fastest, 22 the smallest
+ZSTD_LEVEL = int(os.environ.get("TEI_ZSTD_LEVEL", 3))
+# Size in bytes below which responses which are not streamed are not compressed
+COMPRESSION_MIN_SIZE = int(os.environ.get("TEI_COMPRESSION_MIN_SIZE", 1024))
+# Fraction of successful requests written to the request log, failed requests are always logged
+LOG_SAMPLE_RATE = float(os.environ.get("TEI_LOG_SAMPLE_RATE", 1.0))
+# Number of bytes of JSON bodies and form fields included in the request log, 0 logs no bodies
+LOG_BODY_MAX_SIZE = int(os.environ.get("TEI_LOG_BODY_MAX_SIZE", 0))
+# Collect metrics of the conversions, exposed on /tei/metrics
+METRICS_ENABLED = env_bool("TEI_METRICS")
+# Add a Server-Timing header with the durations of the processing stages to responses
+SERVER_TIMING = env_bool("TEI_SERVER_TIMING")
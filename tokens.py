@@ -0,0 +1,257 @@
+"""
+Tokens of a Kramerius+ page stored column by column
+
+`PageTokens` keeps the fields of the tokens used by the converter in arrays instead of a dictionary per token. The
+strings of the tokens (content, lemma, POS and features) are stored once in a string table and the tokens refer to
+them by integer codes, as are the NameTag labels. Of the misc, which differs in the token range of every token, only
+the `SpaceAfter=No` flag is kept. An `InternTable` shares the tables by all pages of one conversion, with the
+attribute values prepared from them. Positions are stored as integers and the ALTO boxes as doubles, which keep the
+values of the JSON numbers, so the converted page is the same as from the token dictionaries. The dictionaries are not
+modified and can be released as soon as they are added.
+"""
+from array import array
+from itertools import islice
+from typing import Any, Iterable, Iterator, Optional
+from werkzeug.exceptions import abort
+
+# ALTO attributes of a token in the order of the `alto-*` attributes of words
+ALTO_ATTRIBUTES = ("height", "width", "vpos", "hpos")
+MISSING = float("nan")
+NO_ALTO = (MISSING,) * len(ALTO_ATTRIBUTES)
+# Flags of the ALTO values of a token, bit k marks an integer, bit 4 + k a missing value of `ALTO_ATTRIBUTES[k]`
+MISSING_FLAGS = 0b11110000
+# Entries of a cache of an intern table, the cache is cleared when it is full
+CACHE_MAX_SIZE = 65536
+# Strings and NameTag labels after which a conversion of a stream of pages starts a new intern table
+STRINGS_MAX_SIZE = 1 << 20
+LABELS_MAX_SIZE = 1 << 15
+
+
+def reject_token(token: Any):
+    """Reject a token which is not an object or lacks a required attribute with 400"""
+    if not isinstance(token, dict):
+        abort(400, description="Tokens must be JSON objects.")
+    if "content" not in token:
+        abort(400, description="Attribute `content` is required in all tokens.")
+    if "linguisticMetadata" not in token:
+        abort(400, description="Attribute `linguisticMetadata` is required in all tokens.")
+    if not isinstance(token["linguisticMetadata"], dict):
+        abort(400, description="Attribute `linguisticMetadata` must be a JSON object in all tokens.")
+    if "position" not in token["linguisticMetadata"]:
+        abort(400, description="Attribute `position` is required in all tokens' linguistic metadata.")
+    abort(400, description="Invalid token.")
+
+
+class StringTable:
+    """Distinct values with their integer codes in the order they were added, every value is stored once"""
+
+    __slots__ = ("codes", "values")
+
+    def __init__(self):
+        self.codes = {}
+        # Values indexed by their codes, appended as they are added
+        self.values = []
+
+    def code(self, value: Any) -> int:
+        code = self.codes.setdefault(value, len(self.codes))
+        if code == len(self.values):
+            self.values.append(value)
+        return code
+
+    def update_values(self):
+        """Append the values added directly to `codes` to `values`, only the added values are read"""
+        added = len(self.codes) - len(self.values)
+        if added:
+            self.values.extend(reversed(list(islice(reversed(self.codes), added))))
+
+    def __len__(self) -> int:
+        return len(self.codes)
+
+
+class InternTable:
+    """
+    Strings and attribute values shared by the pages of one conversion
+
+    The tokens of all pages added with the same table refer to one object of every distinct string, so do the
+    attributes of their words. ALTO numbers and positions are formatted once per distinct value and the attributes of
+    a word are prepared once per distinct combination of its POS, features and lemma, see `attributes`.
+    """
+
+    __slots__ = ("strings", "labels", "numbers", "positions", "attributes")
+
+    def __init__(self, strings: StringTable = None, labels: StringTable = None):
+        self.strings = strings if strings is not None else StringTable()
+        self.labels = labels if labels is not None else StringTable()
+        self.numbers = {}
+        self.positions = {}
+        # Caches of the converter keyed by the codes of the strings, one per set of removed UDPipe attributes
+        self.attributes = {}
+
+    def is_full(self) -> bool:
+        return len(self.strings) >= STRINGS_MAX_SIZE or len(self.labels) >= LABELS_MAX_SIZE
+
+    def format_number(self, value: Any) -> str:
+        """`str` of an ALTO value, each distinct float is formatted once"""
+        # 0.0 and -0.0 are equal keys with different strings
+        if type(value) is not float or value == 0:
+            return str(value)
+        text = self.numbers.get(value)
+        if text is None:
+            if len(self.numbers) >= CACHE_MAX_SIZE:
+                self.numbers.clear()
+            text = self.numbers[value] = str(value)
+        return text
+
+    def format_position(self, position: int) -> str:
+        text = self.positions.get(position)
+        if text is None:
+            if len(self.positions) >= CACHE_MAX_SIZE:
+                self.positions.clear()
+            text = self.positions[position] = str(position)
+        return text
+
+    def attribute_cache(self, key: tuple) -> dict:
+        """Cache of the converter for a set of removed attributes, cleared when it is full"""
+        cache = self.attributes.setdefault(key, {})
+        if len(cache) >= CACHE_MAX_SIZE:
+            cache.clear()
+        return cache
+
+
+class PageTokens:
+    """
+    Columns of the tokens of a page, see `converter.generate_tei_page` for the fields of a token
+
+    Missing linguistic metadata are stored as empty strings. Missing ALTO values are stored as NaN and flagged, as are
+    the values which were integers. ALTO values which are not numbers are kept aside.
+    """
+
+    __slots__ = ("strings", "labels", "content", "lemma", "upos", "feats", "space_after_no", "position",
+                 "label_offsets", "label_codes", "alto", "alto_flags", "alto_other")
+
+    def __init__(self, intern: InternTable = None):
+        self.strings = intern.strings if intern is not None else StringTable()
+        self.labels = intern.labels if intern is not None else StringTable()
+        self.content = array("I")
+        self.lemma = array("I")
+        self.upos = array("I")
+        self.feats = array("I")
+        # 1 if the misc of the token contains `SpaceAfter=No`
+        self.space_after_no = array("B")
+        self.position = array("q")
+        # NameTag labels of token i are label_codes[label_offsets[i]:label_offsets[i + 1]]
+        self.label_offsets = array("I", [0])
+        self.label_codes = array("I")
+        # ALTO attribute k of token i is alto[4 * i + k]
+        self.alto = array("d")
+        self.alto_flags = array("B")
+        self.alto_other = {}
+
+    @classmethod
+    def from_tokens(cls, tokens: Iterable[dict], intern: InternTable = None) -> "PageTokens":
+        """Columns of token dictionaries, with the strings shared with other pages of `intern` if given"""
+        page_tokens = cls(intern)
+        page_tokens.extend(tokens)
+        return page_tokens
+
+    def extend(self, tokens: Iterable[dict]):
+        """Add token dictionaries, invalid tokens are rejected with 400"""
+        codes = self.strings.codes
+        code = codes.setdefault
+        label_code = self.labels.code
+        content, lemma, upos, feats = (column.append for column in (self.content, self.lemma, self.upos, self.feats))
+        space_after_no = self.space_after_no.append
+        add_position = self.position.append
+        label_codes = self.label_codes
+        add_label_offset = self.label_offsets.append
+        add_alto = self.alto.extend
+        add_alto_flags = self.alto_flags.append
+        try:
+            for token in tokens:
+                try:
+                    token_content = token["content"]
+                    linguistic_metadata = token["linguisticMetadata"]
+                    position = linguistic_metadata["position"]
+                except (KeyError, TypeError):
+                    reject_token(token)
+                if type(position) is not int:
+                    abort(400, description="Attribute `position` must be an integer in all tokens' linguistic "
+                                           "metadata.")
+
+                get = linguistic_metadata.get
+                content(code(token_content, len(codes)))
+                lemma(code(get("lemma", ""), len(codes)))
+                upos(code(get("uPosTag", ""), len(codes)))
+                feats(code(get("feats", ""), len(codes)))
+                misc = get("misc")
+                space_after_no(type(misc) is str and "SpaceAfter=No" in misc)
+                add_position(position)
+                if "nameTagMetadata" in token:
+                    label_codes.extend([label_code(name_tag) for name_tag in token["nameTagMetadata"].split("|")])
+                add_label_offset(len(label_codes))
+
+                alto_metadata = token.get("altoMetadata")
+                if type(alto_metadata) is not dict:
+                    add_alto(NO_ALTO)
+                    add_alto_flags(MISSING_FLAGS)
+                    continue
+                get = alto_metadata.get
+                height, width, vpos, hpos = values = get("height"), get("width"), get("vpos"), get("hpos")
+                if type(height) is float and type(width) is float and type(vpos) is float and type(hpos) is float:
+                    add_alto(values)
+                    add_alto_flags(0)
+                else:
+                    add_alto_flags(self._add_alto_values(values, alto_metadata))
+        finally:
+            # the strings are added to `codes` directly
+            self.strings.update_values()
+
+    def _add_alto_values(self, values: tuple, alto_metadata: dict) -> int:
+        """Add ALTO values which are not all floats, returns their flags"""
+        flags = 0
+        for k, (attr, value) in enumerate(zip(ALTO_ATTRIBUTES, values)):
+            value_type = type(value)
+            if value_type is int:
+                flags |= 1 << k
+            elif value_type is not float:
+                flags |= 1 << (4 + k)
+                if attr in alto_metadata:
+                    self.alto_other[(len(self.position) - 1, k)] = value
+                value = MISSING
+            self.alto.append(value)
+        return flags
+
+    def __len__(self) -> int:
+        return len(self.position)
+
+    def token(self, index: int) -> dict:
+        """Dictionary of a token with its content and linguistic metadata, passed to the NameTag element factories"""
+        strings = self.strings.values
+        return {
+            "content": strings[self.content[index]],
+            "linguisticMetadata": {
+                "position": self.position[index],
+                "lemma": strings[self.lemma[index]],
+                "uPosTag": strings[self.upos[index]],
+                "feats": strings[self.feats[index]]
+            }
+        }
+
+    def alto_value(self, index: int, k: int) -> Optional[Any]:
+        """Value of the ALTO attribute `ALTO_ATTRIBUTES[k]` of a token, None if it is missing"""
+        flags = self.alto_flags[index]
+        if flags >> (4 + k) & 1:
+            return self.alto_other.get((index, k))
+        value = self.alto[4 * index + k]
+        return int(value) if flags >> k & 1 else value
+
+    def alto_rows(self) -> Iterator[tuple]:
+        """ALTO values of the tokens, tuples of the values of `ALTO_ATTRIBUTES` with None for missing values"""
+        rows = zip(*[iter(self.alto)] * len(ALTO_ATTRIBUTES))
+        for index, (flags, row) in enumerate(zip(self.alto_flags, rows)):
+            if flags == 0:
+                yield row
+            elif flags == MISSING_FLAGS and not self.alto_other:
+                yield (None,) * len(ALTO_ATTRIBUTES)
+            else:
+                yield tuple(self.alto_value(index, k) for k in range(len(ALTO_ATTRIBUTES)))
@@ -1,8 +1,18 @@
+import os
+from collections import OrderedDict
 from logging import Logger
-from xml.dom import minidom
-from lxml.etree import fromstring, XMLSchema, Error
-from xml.etree.ElementTree import tostring, Element
-from flask import make_response, json, request, abort
+from shutil import copyfileobj
+from tempfile import SpooledTemporaryFile
+from threading import Lock
+from time import perf_counter
+from io import BytesIO
+from typing import BinaryIO, List, Iterator, Iterable, Tuple, Hashable, Any, Optional
+from lxml.etree import XMLPullParser, XMLSchema, Error
+from xml.etree.ElementTree import Element, Comment, ProcessingInstruction
+from flask import make_response, json, request, abort, g, Response
+from werkzeug.exceptions import HTTPException, BadRequest
+from metrics import stage, timed
+from settings import SCHEMA_FILE, SPOOL_MAX_SIZE
 
 calendar = {
     "leden": "01",
@@ -26,22 +36,393 @@ def month_to_number(month):
     return month
 
 
+XML_NAMESPACE = "http://www.w3.org/XML/1998/namespace"
+XML_DECLARATION = '<?xml version="1.0" ?>'
+INDENT = " " * 2
+NDJSON_MIMETYPES = ("application/x-ndjson", "application/jsonl", "application/jsonlines")
+
+
+def escape_text(text: str) -> str:
+    if "&" in text:
+        text = text.replace("&", "&amp;")
+    if "<" in text:
+        text = text.replace("<", "&lt;")
+    if "\"" in text:
+        text = text.replace("\"", "&quot;")
+    if ">" in text:
+        text = text.replace(">", "&gt;")
+    return text
+
+
+def escape_attribute(value: str) -> str:
+    value = escape_text(value)
+    if "\n" in value or "\r" in value or "\t" in value:
+        value = value.replace("\n", "&#10;").replace("\r", "&#13;").replace("\t", "&#9;")
+    return value
+
+
+def drop_blank_lines(text: str) -> str:
+    lines = text.split("\n")
+    return "\n".join([lines[0]] + [line for line in lines[1:-1] if line.strip()] + [lines[-1]])
+
+
+class XMLSerializer:
+    """
+    Serializer of ElementTree elements into indented XML lines
+
+    The output matches the former `tostring` + `minidom.toprettyxml` pipeline with blank lines removed: elements
+    containing only text are written on one line, whitespace-only text between elements is dropped. In compact mode
+    no indentation is written. Namespaced names other than `xml:` are declared on the element where they are used.
+    """
+
+    def __init__(self, pretty: bool = True):
+        self.indent = INDENT if pretty else ""
+        self.pretty = pretty
+        self.names = {}
+        self.prefixes = {XML_NAMESPACE: "xml"}
+
+    def lines(self, elem: Element, depth: int = 0) -> List[str]:
+        lines = []
+        self._serialize(elem, lines, self.indent * depth, {XML_NAMESPACE})
+        return lines
+
+    def _serialize(self, elem: Element, lines: List[str], indent: str, scope: set):
+        tag = elem.tag
+        if tag is Comment:
+            lines.append("%s<!--%s-->" % (indent, elem.text or ""))
+            return
+        if tag is ProcessingInstruction:
+            lines.append("%s<?%s?>" % (indent, elem.text or ""))
+            return
+
+        declarations = []
+        tag = self._name(tag, scope, declarations)
+        attrs = "".join(' %s="%s"' % (self._name(k, scope, declarations), escape_attribute(v))
+                        for k, v in elem.items())
+        if declarations:
+            scope = scope | set(declarations)
+            attrs = "".join(' xmlns:%s="%s"' % (self.prefixes[uri], escape_attribute(uri))
+                            for uri in declarations) + attrs
+
+        text = elem.text
+        if len(elem) == 0:
+            if text:
+                if "\n" in text and self.pretty:
+                    text = drop_blank_lines(escape_text(text))
+                else:
+                    text = escape_text(text)
+                lines.append("%s<%s%s>%s</%s>" % (indent, tag, attrs, text, tag))
+            else:
+                lines.append("%s<%s%s/>" % (indent, tag, attrs))
+            return
+
+        lines.append("%s<%s%s>" % (indent, tag, attrs))
+        child_indent = indent + self.indent
+        if text:
+            self._text(text, lines, child_indent)
+        for child in elem:
+            self._serialize(child, lines, child_indent, scope)
+            if child.tail:
+                self._text(child.tail, lines, child_indent)
+        lines.append("%s</%s>" % (indent, tag))
+
+    def _text(self, text: str, lines: List[str], indent: str):
+        if not text.strip():
+            return
+        if self.pretty:
+            lines.extend(line for line in (indent + escape_text(text)).split("\n") if line.strip())
+        else:
+            lines.append(escape_text(text))
+
+    def _name(self, name: str, scope: set, declarations: list) -> str:
+        if name[0] != "{":
+            return name
+        uri, local = name[1:].split("}", 1)
+        if uri not in self.prefixes:
+            self.prefixes[uri] = "ns%d" % (len(self.prefixes) - 1)
+        if uri not in scope and uri not in declarations:
+            declarations.append(uri)
+        return "%s:%s" % (self.prefixes[uri], local)
+
+
+def serialize(elem: Element, pretty: bool = True, declaration: bool = True) -> str:
+    """Serialize an element to an XML document, indented unless `pretty` is False"""
+    newline = "\n" if pretty else ""
+    lines = XMLSerializer(pretty).lines(elem)
+    if declaration:
+        lines.insert(0, XML_DECLARATION)
+    return newline.join(lines)
+
+
 def prettify(elem: Element) -> str:
-    rough_string = tostring(elem, 'utf-8')
-    parsed = minidom.parseString(rough_string)
-    return '\n'.join([line for line in parsed.toprettyxml(indent=' '*2).split('\n') if line.strip()])
+    return serialize(elem)
+
+
+class XMLStreamWriter:
+    """
+    Incremental XML writer
+
+    Elements are opened and closed one by one and whole subtrees can be written in between, so only the subtree
+    being written has to be held in memory. The output is the same as `serialize` of the complete document. A writer
+    with a non-zero `depth` writes a fragment that continues an already started document at that indentation level.
+    """
+
+    def __init__(self, out: BinaryIO, pretty: bool = True, depth: int = 0):
+        self.out = out
+        self.serializer = XMLSerializer(pretty)
+        self.newline = "\n" if pretty else ""
+        self.depth = depth
+        self.stack = []
+        self.pending = None
+        self.started = depth > 0
+
+    def declaration(self):
+        self._write(XML_DECLARATION)
+
+    def start(self, tag: str, attrs: dict = None):
+        self.flush()
+        attrs = "".join(' %s="%s"' % (k, escape_attribute(v)) for k, v in (attrs or {}).items())
+        self.pending = "%s<%s%s" % (self._indent(), tag, attrs)
+        self.stack.append(tag)
+
+    def start_element(self, elem: Element):
+        """Open an element with the tag and attributes of `elem`, its text and children are not written"""
+        self.flush()
+        scope = {XML_NAMESPACE}
+        declarations = []
+        tag = self.serializer._name(elem.tag, scope, declarations)
+        attrs = "".join(' %s="%s"' % (self.serializer._name(k, scope, declarations), escape_attribute(v))
+                        for k, v in elem.items())
+        attrs = "".join(' xmlns:%s="%s"' % (self.serializer.prefixes[uri], escape_attribute(uri))
+                        for uri in declarations) + attrs
+        self.pending = "%s<%s%s" % (self._indent(), tag, attrs)
+        self.stack.append(tag)
+
+    def text(self, text: str):
+        """Write text inside the last opened element, whitespace-only text is dropped as by `serialize`"""
+        lines = []
+        self.serializer._text(text, lines, self._indent())
+        if lines:
+            self.flush()
+            for line in lines:
+                self._write(line)
+
+    def end(self):
+        tag = self.stack.pop()
+        if self.pending is not None:
+            self._write(self.pending + "/>")
+            self.pending = None
+        else:
+            self._write("%s</%s>" % (self._indent(), tag))
+
+    def element(self, elem: Element):
+        self.flush()
+        self._write(self.newline.join(self.serializer.lines(elem, self.depth + len(self.stack))))
+
+    def flush(self):
+        """Write the start tag of the last opened element, the element can not be written as empty anymore"""
+        if self.pending is not None:
+            self._write(self.pending + ">")
+            self.pending = None
+
+    def _indent(self) -> str:
+        return self.serializer.indent * (self.depth + len(self.stack))
+
+    def _write(self, data: str):
+        if self.started:
+            data = self.newline + data
+        self.started = True
+        self.out.write(data.encode("utf-8"))
+
+
+def iter_serialize(elem: Element, pretty: bool = True, levels: int = 3) -> Iterator[bytes]:
+    """
+    Serialize an element to an XML document in chunks, the same as `serialize`
+
+    Elements of the first `levels` levels are written as start and end tags and their subtrees one by one, so no chunk
+    contains more than one subtree below that level. Elements with namespaced names, text or tails are written whole.
+    """
+    output = BytesIO()
+    writer = XMLStreamWriter(output, pretty)
+    writer.declaration()
+
+    def write(element: Element, level: int) -> Iterator[bytes]:
+        if level >= levels or len(element) == 0 or not is_splittable(element):
+            writer.element(element)
+            yield drain(output)
+            return
+        writer.start(element.tag, dict(element.items()))
+        for child in element:
+            yield from write(child, level + 1)
+        writer.end()
+
+    yield from write(elem, 0)
+    yield drain(output)
+
+
+def is_splittable(elem: Element) -> bool:
+    """Whether the start and end tags of an element can be written by `XMLStreamWriter.start` and `end`"""
+    if not isinstance(elem.tag, str) or elem.tag[0] == "{" or any(key[0] == "{" for key in elem.keys()):
+        return False
+    if elem.text and elem.text.strip():
+        return False
+    return not any(child.tail and child.tail.strip() for child in elem)
+
+
+def drain(buffer: BytesIO) -> bytes:
+    """Return the content of a buffer and empty it"""
+    data = buffer.getvalue()
+    buffer.seek(0)
+    buffer.truncate()
+    return data
+
+
+def spool(stream: BinaryIO, max_size: int = SPOOL_MAX_SIZE) -> SpooledTemporaryFile:
+    """Copy a stream to a temporary file, kept in memory up to `max_size` bytes, and rewind it"""
+    spooled = SpooledTemporaryFile(max_size=max_size)
+    copyfileobj(stream, spooled)
+    spooled.seek(0)
+    return spooled
+
+
+def read_ndjson(stream: BinaryIO) -> Iterator:
+    """Decode a stream of newline delimited JSON values, a line which is not valid JSON is returned as BadRequest"""
+    for line in stream:
+        if not line.strip():
+            continue
+        try:
+            yield json.loads(line)
+        except ValueError as e:
+            yield BadRequest(description="Invalid JSON: %s" % e)
+
 
+def stream_pages_xml(results: Iterable[Tuple[str, Element]], pretty: bool = True) -> Iterator[bytes]:
+    """Write converted pages as `div` elements wrapped in a `pages` element, failed pages as `error` elements"""
+    output = BytesIO()
+    writer = XMLStreamWriter(output, pretty)
+    writer.declaration()
+    writer.start("pages")
+    for index, (page_id, result) in enumerate(results):
+        if isinstance(result, HTTPException):
+            error = Element("error", {"index": str(index), "code": str(result.code)})
+            if page_id is not None:
+                error.set("id", str(page_id))
+            error.text = result.description
+            result = error
+        writer.element(result)
+        yield drain(output)
+    writer.end()
+    yield drain(output)
 
-def prepare_filter(filter_name):
-    if filter_name not in request.form:
+
+def stream_pages_ndjson(results: Iterable[Tuple[str, Element]], pretty: bool = True) -> Iterator[bytes]:
+    """Write one JSON object per converted page with its `xml` or the `error` that occurred"""
+    for index, (page_id, result) in enumerate(results):
+        line = {"index": index, "id": page_id}
+        if isinstance(result, HTTPException):
+            line["error"] = {"code": result.code, "name": result.name, "description": result.description}
+        else:
+            line["xml"] = serialize(result, pretty, declaration=False)
+        yield (json.dumps(line) + "\n").encode("utf-8")
+
+
+def prepare_filter(filter_name, source: dict = None):
+    """
+    Read a filter from the form data, or from `source` if given, as a list of lowercase names
+
+    The filter is a comma separated string, in `source` it can also be a list. None if the filter is not present.
+    """
+    if source is None:
+        source = request.form
+    if filter_name not in source:
         return None
-    attributes = request.form.get(filter_name, '').split(',')
-    return list(map(lambda x: x.lower().strip(), attributes))
+    attributes = source.get(filter_name) or ''
+    if isinstance(attributes, str):
+        attributes = attributes.split(',')
+    return list(map(lambda x: str(x).lower().strip(), attributes))
+
+
+def is_ndjson() -> bool:
+    return request.mimetype in NDJSON_MIMETYPES
+
+
+def prepare_flag(flag_name) -> bool:
+    return request.values.get(flag_name, '').strip().lower() in ('1', 'true', 'yes', 'on')
+
+
+def read_json():
+    """Decode the JSON body of the current request regardless of its content type"""
+    with stage("read"):
+        return request.get_json(True)
+
+
+def count_bytes(chunks: Iterable[bytes], size: List[int]) -> Iterator[bytes]:
+    """Pass a streamed response through and add the number of its bytes to `size[0]`"""
+    try:
+        for chunk in chunks:
+            size[0] += len(chunk)
+            yield chunk
+    finally:
+        if hasattr(chunks, "close"):
+            chunks.close()
+
+
+def close_after(chunks: Iterable[bytes], file: BinaryIO) -> Iterator[bytes]:
+    """Pass a streamed response through and close `file` once it has been sent or aborted"""
+    try:
+        yield from chunks
+    finally:
+        file.close()
+
+
+def set_request_log(name: str, value):
+    """Add a field to the request log record of the current request"""
+    record = g.get("request_log")
+    if record is not None:
+        record[name] = value
+
+
+def count_pages(pages: Iterable) -> Iterator:
+    """Pass pages through and record their number in the request log, also for streamed requests"""
+    for count, page in enumerate(pages, 1):
+        set_request_log("pages", count)
+        yield page
+
+
+def request_log_record(response: Response, body_max_size: int = 0) -> dict:
+    """
+    Describe the current request for the request log without reading its body
+
+    :param response: response of the request
+    :param body_max_size: number of bytes of the body included in the record, 0 for none. Only JSON bodies and form
+        fields already read by the view are included, uploaded files and streamed bodies never are.
+    :returns: a dictionary serializable to JSON
+    """
+    record = {
+        "method": request.method,
+        "path": request.path,
+        "status": response.status_code,
+        "content_type": request.mimetype or None,
+        "content_length": request.content_length,
+        "response_length": response.content_length if not response.is_streamed else None
+    }
+    if body_max_size > 0:
+        body = None
+        # bodies are never read for the log, only the body cached by `get_data` and the parsed form are included
+        if request.is_json:
+            body = getattr(request, "_cached_data", None)
+        elif "form" in request.__dict__:
+            body = json.dumps(request.form.to_dict(flat=False)).encode("utf-8")
+        if body is not None:
+            record["body"] = body[:body_max_size].decode("utf-8", "replace")
+            record["body_truncated"] = len(body) > body_max_size
+    return record
 
 
 def xml_response_handler(data, code, headers):
     if isinstance(data, dict) and "xml" in data and isinstance(data["xml"], Element):
-        data = prettify(data["xml"])
+        with stage("serialize"):
+            data = serialize(data["xml"], not prepare_flag("compact"))
     resp = make_response(data, code)
     resp.headers.extend(headers)
     return resp
@@ -51,6 +432,10 @@ def xml_response(elem: Element) -> dict:
     return {"xml": elem}
 
 
+def json_response(data, code: int = 200) -> Response:
+    return Response(json.dumps(data), code, mimetype="application/json")
+
+
 def content_type_json(func):
     def wrapper():
         res = func()
@@ -71,28 +456,110 @@ def exception_handler(e):
     return response
 
 
-def validate(elem: Element, logger: Logger = None):
-    xml_string = tostring(elem, 'utf-8')
-    try:
-        xml_file = fromstring(xml_string)
-    except Error as e:
-        # abort(500, description=str(e))
-        if logger:
-            logger.error(str(e))
-        return
+class SchemaCache:
+    """
+    Compiled XSD schema shared by all requests of a worker
+
+    The schema is compiled on first use (or by `load`) and compiled again only when the modification time of the
+    schema file changes. Only the compilation is locked, see `validate_chunks`.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.compile_time = None
+        self._schema = None
+        self._mtime = None
+        self._lock = Lock()
+
+    def load(self, logger: Logger = None) -> XMLSchema:
+        mtime = os.stat(self.path).st_mtime_ns
+        with self._lock:
+            if self._schema is None or self._mtime != mtime:
+                start = perf_counter()
+                self._schema = XMLSchema(file=self.path)
+                self._mtime = mtime
+                self.compile_time = perf_counter() - start
+                if logger:
+                    logger.info("Schema %s compiled in %.3f s", self.path, self.compile_time)
+            return self._schema
+
+    def validate_chunks(self, chunks: Iterable[bytes], logger: Logger = None) -> bool:
+        """
+        Validate a document fed to the parser in chunks
+
+        Parsed elements are dropped as soon as they are validated, so the document is never held by lxml as a whole.
+        Every validation has its own parser, the compiled schema is only read and is not locked.
+        """
+        parser = XMLPullParser(events=("end",), schema=self.load(logger))
+        start = perf_counter()
+        try:
+            for chunk in chunks:
+                parser.feed(chunk)
+                for _, elem in parser.read_events():
+                    elem.clear()
+                    while elem.getprevious() is not None:
+                        del elem.getparent()[0]
+            parser.close()
+        except Error as e:
+            # the document is compact, line numbers of the errors are meaningless
+            if logger:
+                logger.error("INVALID DOCUMENT: %s" % getattr(e, "msg", str(e)).encode("utf-8"))
+            return False
+        finally:
+            if logger:
+                logger.debug("Schema validation took %.3f s", perf_counter() - start)
+        return True
+
+
+schema_cache = SchemaCache(SCHEMA_FILE)
+
 
+class LRUCache:
+    """
+    Thread-safe mapping keeping at most `max_size` most recently used entries
+
+    A cache with `max_size` 0 stores nothing. Values are returned as stored, callers that mutate them must copy them.
+    """
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        with self._lock:
+            value = self._entries.get(key)
+            if value is not None:
+                self._entries.move_to_end(key)
+            return value
+
+    def put(self, key: Hashable, value: Any):
+        if self.max_size <= 0:
+            return
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+@timed("validate")
+def validate(elem: Element, logger: Logger = None) -> Optional[bool]:
+    """
+    Validate a document against the schema without building a copy of it
+
+    The document is serialized and parsed page by page. None if the schema can not be loaded.
+    """
     try:
-        xml_validator = XMLSchema(file="scheme/document.xsd")
-    except Error as e:
-        # abort(500, description=str(e))
+        return schema_cache.validate_chunks(iter_serialize(elem, pretty=False), logger)
+    except (Error, OSError) as e:
         if logger:
             logger.error(str(e))
-        return
-
-    if not xml_validator.validate(xml_file):
-        error = xml_validator.error_log.last_error
-        message = "ERROR ON LINE %s: %s" % (error.line, error.message.encode("utf-8"))
-        # abort(500, description=message)
-        if logger:
-            logger.error(message)
-        return
+        return None